@@ -1,78 +1,23 @@
 import os
 import time
 import typing
-import struct
+from i2c_packet import I2CPacket, Backoff
+from metrics import Metrics
 
-class I2CPacket:
+class EepromTransport:
     '''
-    Contains functions that aim to abstract away all the functionality
-    related to packets, mainly building it and verifying packet integrity
-    Packet structure:
-    Size of data                - Python type
-    245 byte for data           - bytes
-    1 byte for data length      - integer
-    1 byte for status messages  - bytes
-    4 bytes for checksum        - integer
-    4 bytes for sequence number - integer
-    1 byte for sender ID        - bytes
+    The slave-eeprom buffer file, kept open; reads and writes are positional.
+    i2c_loopback.SharedBuffer has the same interface for testing
     '''
 
-    struct_format: str = '=245sBcIIc'
-    data_len: int = 245
-    data_index: int = 0
-    dlen_index: int = 1
-    stat_index: int = 2
-    par_index: int = 3
-    seq_index: int = 4
-    id_index: int = 5
-
-    def create_pkt(data: bytes, size: int, status: str,
-                   sequence: int, ID: str):
-        '''
-        Builds a packet containing the specified data. Adds in checksum.
-        Returns bytes object for writing.
-        '''
-        # Check lengths of input. Return false if packing cannot be done
-        if size > I2CPacket.data_len:
-            return False
-
-        # Create packet with zero checksum for calculation
-        pkt_array = bytearray(struct.pack(I2CPacket.struct_format,
-                                data, size, status[:1].encode(),
-                                          0, sequence, ID[:1].encode()))
-
-        # Use the sum of the packet array to set the checksum
-        pkt_array[247:251] = sum(pkt_array).to_bytes(4, 'little')
-
-        # Convert to bytes object and return it
-        pkt = bytes(pkt_array)
-
-        return pkt
-
-    def parse_pkt(pkt: bytes):
-        '''
-        Unpacks packet, returns resulting tuple
-        '''
-        return struct.unpack(I2CPacket.struct_format, pkt)
-
-    def verify_pkt(pkt: bytes):
-        '''
-        Given a packet, calculates checksum, checks with provided checksum of
-        packet.
-        Returns True if they match, False if they do not.
-        '''
-        # Convert to byte array
-        pkt_array = bytearray(pkt)
-
-        # Extract checksum from packet
-        provided = int.from_bytes(pkt_array[247:251], 'little', signed=False)
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_RDWR)
 
-        # Substitute checksum with all zeros
-        pkt_array[247:251] = bytearray(4)
+    def read(self, offset: int, size: int):
+        return os.pread(self.fd, size, offset)
 
-        # Calculate checksum
-        calculated = sum(pkt_array)
-        return calculated == provided
+    def write(self, offset: int, data):
+        return os.pwrite(self.fd, data, offset)
 
 class Nano_I2CBus:
     '''
@@ -90,18 +35,38 @@ class Nano_I2CBus:
     blocksize: int = 256
     timewait: float = 0.2 # Time delay to help with data transmission
 
+    spin_time: float = 0.002  # Poll without sleeping this long after a write
+    min_wait: float = 0.0005  # First poll delay once spinning is over
+    max_wait: float = 0.02    # Poll delay ceiling while the buffer is quiet
+
+    window: int = 16          # Chunks streamed before the Pi is asked what it missed
+    pi_stream_wait: float = 0.005  # I2CBus.stream_wait, the Pi's poll delay while chunks stream in
+    pi_read_time: float = 0.006    # One 256 byte read by the Pi at 400 kHz
+    max_rounds: int = 8       # Resend rounds per window before giving up
+
     pkt_self_id: str = 'J'           # This system's packet ID
     pkt_targ_id: str = 'P'           # The target packet ID (RPi)
 
-    def __init__(self):
-        self.log = open('logfile', 'w')
+    def __init__(self, metrics: Metrics = None, transport=None):
+        # Counters, round trip timings and the log file, see metrics.py
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tx_buf = bytearray(I2CPacket.size)
+
+        # Packets are written in the framing (protocol version) of the last
+        # valid packet from the Pi, version 1 until the Pi switches
+        self.codec = I2CPacket
+
+        # The eeprom buffer by default, a SharedBuffer off the robot
+        self.transport = transport if transport is not None else EepromTransport(self.buf)
+        self.backoff = Backoff(self.spin_time, self.min_wait, self.max_wait)
+
+        # Checksum, sequence and sender bytes of the last packet looked at
+        self.last_header = None
         self.vision = False
         print('Nano I2C Ready')
 
     def write_log(self, msg: str):
-        date = time.asctime()
-
-        self.log.write(date + ': ' + msg + '\n')
+        self.metrics.log(msg)
 
     def write_pkt(self, response, status, sequence):
         '''
@@ -112,80 +77,92 @@ class Nano_I2CBus:
 
         Returns number bytes sent
         '''
-        pkt = I2CPacket.create_pkt(response, len(response), status, 
-                                sequence, self.pkt_self_id)
-        
-        # If pkt is already in bytes, do nothing
-        if type(pkt) == bytes:
-            pass
-
-        # Otherwise if the data is a string, encode it with UTF-8
-        elif type(pkt) == str:
-            pkt = pkt.encode(encoding='UTF-8', errors='replace')
-
-        # Otherwise try to convert it to a bytes object
-        else:
-            try:
-                pkt = bytes(pkt)
-
-            # If this fails, return false
-            except:
-                return False
+        # Build the packet in place in the reusable transmit buffer
+        pkt = self.codec.pack_into(self.tx_buf, response, len(response),
+                                   status, sequence, self.pkt_self_id)
+        if not pkt:
+            return False
 
-        with open(self.buf, 'wb') as buf:
-            return buf.write(pkt)
+        # Whatever the Pi writes next is new, even if it repeats a packet
+        self.last_header = None
+        self.backoff.reset()
+        self.metrics.count('i2c_packets_sent')
+        return self.transport.write(0, pkt)
 
     def read_pkt(self, size: int = blocksize):
         '''
         Reads from the eeprom buffer.
         Returns the data as a bytes object.
         '''
-        # Open buffer and return first 256 bytes
-        with open(self.buf, 'rb') as buf:
-            return buf.read(self.blocksize)
+        # Return first 256 bytes
+        return self.transport.read(0, self.blocksize)
+
+    def poll_pkt(self):
+        '''
+        Looks at the buffer once without blocking.
+        Returns the packet if the Pi wrote a new valid one, None otherwise.
+        An unchanged buffer is not parsed or checksummed again.
+        '''
+        data = self.read_pkt()
+
+        # The header bytes (checksum, sequence, sender) change with every
+        # new packet, and they are the last bytes the Pi writes
+        header = data[I2CPacket.header_start:]
+        if header == self.last_header:
+            return None
+        self.last_header = header
+
+        # If the sender ID is ourselves, nothing was received yet
+        if header[-1:] == self.pkt_self_id.encode():
+            return None
+
+        # Check its integrity (checksum)
+        if not I2CPacket.verify_pkt(data):
+            # If invalid, send an error message so pi resends it
+            print('Requesting new packet (invalid)')
+            self.metrics.count('i2c_checksum_failures')
+            self.metrics.count('i2c_resend_requests')
+            self.write_pkt(b'', 'e', 0)
+            return None
+
+        self.metrics.count('i2c_packets_received')
+        self.codec = I2CPacket.framing(data)
+        return I2CPacket.parse_pkt(data)
 
     def wait_response(self):
         '''
-        Blocks for one second or until the target responds
+        Blocks for three seconds or until the target responds
         Returns resulting packet, if valid packet is received
         Returns false otherwise
         '''
-        # Timeout in 1 second
-        timeout = time.time() + 3
-
-        # Continuously check the Pi for its response
-        while timeout > time.time():
+        # Timeout in 3 seconds
+        timeout = time.monotonic() + 3
 
-            # Get the packet from the Pi and Parse
-            data = self.read_pkt()
-            pkt = I2CPacket.parse_pkt(data)
+        # Check the Pi for its response, backing off while nothing changes
+        while timeout > time.monotonic():
+            pkt = self.poll_pkt()
+            if pkt:
+                self.backoff.reset()
+                return pkt
 
-            # Grab sender ID to know if transmission was complete
-            sender = pkt[I2CPacket.id_index].decode(errors='ignore')
-
-            # If the sender ID is not ourselves, we received a transmission
-            if sender != self.pkt_self_id:
-
-                # Check its integrity (checksum)
-                if I2CPacket.verify_pkt(data):
-                    return pkt
-                else:
-                    # If invalid, send an error message so pi resends it
-                    print('Requesting new packet (invalid)')
-                    self.write_pkt(b'', 'e', 0)
+            delay = self.backoff.delay()
+            if delay:
+                time.sleep(delay)
 
         # If timeout occurs, return false
+        self.metrics.count('i2c_timeouts')
         self.write_log('Timeout occured. Returning false.')
         return False
     
-    def file_send(self, filename: str):
+    def file_send(self, filename: str, size: int = None):
         '''
         Send a file from the jetson to the pi
+        If size is given it is announced with the name as "name|size"
         '''
         sequence = 0
 
         # Send File name and wait for a response to start
-        if not self.send_and_wait(filename.encode(), 'd', sequence):
+        if not self.send_and_wait(self.file_header(filename, size), 'd', sequence):
             print('Error writing packet')
             self.write_log('Error writing data')
             return False
@@ -204,7 +181,7 @@ class Nano_I2CBus:
         else:
             with reqfile:
                 # Read first chunk of data
-                data = reqfile.read(I2CPacket.data_len)
+                data = reqfile.read(self.codec.data_len)
                 # While we are still grabbing data from the file
                 while data:
                     # Write data to buffer to be sent
@@ -216,16 +193,98 @@ class Nano_I2CBus:
                     sequence += 1
 
                     # Read next chunk of data
-                    data = reqfile.read(I2CPacket.data_len)
+                    data = reqfile.read(self.codec.data_len)
 
         # End transmission
         # Notify Pi transmission is over
         self.write_pkt(b'end', 't', sequence)
 
+        self.metrics.event('file_sent', file=filename, chunks=sequence, windowed=False)
         self.write_log('Ending transmission')
 
         print('Ending transmission')
         
+    def file_send_windowed(self, filename: str, size: int = None):
+        '''
+        Send a file from the jetson to the pi without a round trip per chunk.
+        Each window of chunks is streamed with 's' packets, one chunk per
+        poll of the Pi (pi_stream_wait + pi_read_time). Then a single 'k'
+        packet asks the Pi which chunks of the window it missed and only
+        those are resent, holding them twice as long each round.
+        '''
+        # Try to open requested file for reading, send an empty file if it
+        # does not exist
+        try:
+            with open(filename, 'rb') as reqfile:
+                data = reqfile.read()
+        except FileNotFoundError:
+            self.write_log('File does not exist')
+            data = b''
+
+        step = self.codec.data_len
+        chunks = [data[i:i + step] for i in range(0, len(data), step)]
+
+        # Send File name and wait for the Pi to be ready
+        if not self.send_and_wait(self.file_header(filename, size), 'd', 0):
+            print('Error writing packet')
+            self.write_log('Error writing data')
+            return False
+
+        print('Starting Transmission')
+
+        for base in range(0, len(chunks), self.window):
+            count = min(self.window, len(chunks) - base)
+            pending = list(range(base, base + count))
+            period = self.pi_stream_wait + self.pi_read_time
+            rounds = 0
+
+            while pending:
+                if rounds:
+                    self.metrics.count('i2c_chunks_resent', len(pending))
+                if rounds == self.max_rounds:
+                    print('Error writing packet')
+                    self.write_log('Too many resends for window ' + str(base))
+                    return False
+                rounds += 1
+
+                # Stream the chunks without waiting for replies, each one
+                # stays in the buffer until the Pi has polled it once
+                for seq in pending:
+                    sent = time.monotonic()
+                    self.write_pkt(chunks[seq], 's', seq)
+                    time.sleep(max(0.0, sent + period - time.monotonic()))
+
+                # Ask which chunks of the window did not make it
+                check = I2CPacket.window_check.pack(base, count)
+                reply = self.send_and_wait(check, 'k', base)
+                if not reply:
+                    print('Error writing packet')
+                    self.write_log('Error writing data')
+                    return False
+
+                bitmap = reply[I2CPacket.data_index][:reply[I2CPacket.dlen_index]]
+                pending = I2CPacket.missing_seqs(bitmap, base, count)
+                period *= 2
+
+        # Notify Pi transmission is over, the sequence is the chunk count
+        self.write_pkt(b'end', 't', len(chunks))
+
+        self.metrics.event('file_sent', file=filename, chunks=len(chunks), bytes=len(data),
+                           windowed=True)
+        self.write_log('Ending transmission')
+
+        print('Ending transmission')
+        return True
+
+    def file_header(self, filename: str, size: int = None):
+        '''
+        First packet of a file transfer: the file name, plus its size in
+        bytes when it should be reported to the Pi
+        '''
+        if size is None:
+            return filename.encode()
+        return f'{filename}|{size}'.encode()
+
     def send_and_wait(self, data: bytes, status: str, sequence: int):
         '''
         Send a packet, make continuous reads, resend packets if receiver
@@ -242,7 +301,9 @@ class Nano_I2CBus:
                 return False
 
             # Grab result of the wait
-            result = self.wait_response()
+            self.metrics.count('i2c_round_trips')
+            with self.metrics.span('i2c_round_trip'):
+                result = self.wait_response()
             
             # If wait returns false, return false
             if not result:
@@ -252,7 +313,7 @@ class Nano_I2CBus:
             else:
                 # Resend packet if an error packet was received
                 if result[I2CPacket.stat_index] == b'e':
-                    pass
+                    self.metrics.count('i2c_resends')
 
                 # Return packet if non-error
                 else:
@@ -0,0 +1,56 @@
+'''
+Runs the cord path (collectTubeLocation) against a recorded session so
+throughput can be measured off the robot:
+    python3 benchmark.py session.npz --runs 20
+'''
+import argparse
+import time
+from frameSource import openSource
+from visionSystem import VisionSystem
+from control import collectTubeLocation
+from tracker import BoxTracker
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark collectTubeLocation on a recording')
+    parser.add_argument('recording', help='recorded session (.npz, .bag or directory)')
+    parser.add_argument('--runs', type=int, default=10, help='number of cord requests to time')
+    parser.add_argument('--fps', type=float, help='replay rate, as fast as possible when omitted')
+    parser.add_argument('--weights-dir', default='/home/herbie/OVision2022/yolov5')
+    parser.add_argument('--weights', default='/home/herbie/OVision2022/yolov5/last.pt')
+    parser.add_argument('--backend', default='torch', choices=('torch', 'onnx', 'opencv'),
+                        help='detector backend, see detector.py')
+    parser.add_argument('--quantize', action='store_true', help='use the int8 ONNX model')
+    parser.add_argument('--imgsz', type=int, default=640, help='full frame inference size')
+    parser.add_argument('--roi', type=float, metavar='PADDING',
+                        help='re-detect in a crop around the last box, padded by PADDING box sizes')
+    parser.add_argument('--roi-size', type=int, default=320, help='inference size of the crop')
+    parser.add_argument('--track', type=int, metavar='N',
+                        help='run the detector every N frames and track the box in between')
+    parser.add_argument('--continuous', action='store_true',
+                        help='use the background capture thread like control.py')
+    args = parser.parse_args()
+
+    vis = VisionSystem(args.weights_dir, args.weights, continuous=args.continuous,
+                       frameSource=openSource(args.recording, args.fps),
+                       backend=args.backend, quantize=args.quantize,
+                       inferenceSize=args.imgsz, roiPadding=args.roi, roiSize=args.roi_size,
+                       tracker=BoxTracker(detectEvery=args.track) if args.track else None)
+
+    times = []
+    for run in range(args.runs):
+        start = time.perf_counter()
+        result = collectTubeLocation(vis)
+        times.append(time.perf_counter() - start)
+        print(f'run {run}: {times[-1]:.3f}s -> {result}')
+
+    vis.stopCapture()
+    vis.source.close()
+    times.sort()
+    print(f'cord: mean {sum(times) / len(times):.3f}s  min {times[0]:.3f}s  '
+          f'median {times[len(times) // 2]:.3f}s  max {times[-1]:.3f}s')
+    print(vis.timer.report())
+
+
+if __name__ == '__main__':
+    main()
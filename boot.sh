@@ -1,4 +1,7 @@
 #!/bin/bash
-sleep 10
+# Wait for the I2C slave buffer instead of a fixed delay (at most 10 s)
+for i in $(seq 1 40); do
+    [ -e /sys/bus/i2c/devices/0-0064/slave-eeprom ] && break
+    sleep 0.25
+done
 xterm -hold -e "echo $USER & python3 /home/herbie/OVision2022/yolov5/control.py"
-
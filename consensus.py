@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class TubeConsensus:
+    '''
+    Collects tube samples (x, y, z, angle) in robot coordinates and looks
+    for a group of samples that agree on the tube location.
+    A group is a sample plus every sample whose 3D position is within
+    threshold (cm) of it. A consensus needs minAgreement samples in a group,
+    counting the sample itself.
+    '''
+
+    def __init__(self, threshold=10, minAgreement=3):
+        self.threshold = threshold
+        self.minAgreement = minAgreement
+        self.samples = []
+        self.count = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, sample):
+        self.samples.append(sample)
+
+    def result(self):
+        '''
+        Returns the average (x, y, -z, angle) of the largest agreeing group,
+        None if no group reaches minAgreement yet
+        '''
+        if len(self.samples) < self.minAgreement:
+            return None
+
+        samples = np.asarray(self.samples, dtype=float)
+        points = samples[:, :3]
+
+        # All pairwise distances at once, a sample always agrees with itself
+        distances = np.linalg.norm(points[:, None, :] - points[None, :, :], axis=2)
+        agree = distances < self.threshold
+        counts = agree.sum(axis=1)
+        best = int(counts.argmax())
+        if counts[best] < self.minAgreement:
+            return None
+
+        self.count = int(counts[best])
+        x, y, z, angle = samples[agree[best]].mean(axis=0)
+        return float(x), float(y), -float(z), float(angle)
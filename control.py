@@ -1,8 +1,18 @@
 import math
+import time
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from Nano_I2C import *
 from visionSystem import VisionSystem
+from consensus import TubeConsensus
+from geometry import cameraMount
+from detectionCache import DetectionCache, BackgroundDetector
+from metrics import Metrics
+from i2c_packet import LATEST_VERSION
 
 #Old Offset in centimeters
 #offset_x = 2.9
@@ -15,131 +25,367 @@ offset_y = 6.1
 offset_z = 23.544
 camera_angle = math.radians(60)
 
-def get3Dlocation(realWorldCords):
-    return (realWorldCords[0] ** 2 + realWorldCords[1] ** 2 + realWorldCords[2] ** 2) ** 0.5
+# Camera to robot coordinates with the angle and offsets folded in
+mount = cameraMount(camera_angle, offset_x, offset_y, offset_z)
 
 def translateCoordinates(x, y, depth):
-        #print(f'X: {x} Y: {y} depth: {depth}')
-        camera_hyp = (x ** 2 + y ** 2) ** 0.5
-        center_depth = (depth ** 2 - camera_hyp ** 2) ** 0.5
-        #real_z = depth * math.cos(camera_angle + math.atan(y/center_depth))
-        groundhyp = depth * math.sin(camera_angle + math.atan(-y/center_depth))
-        
-        real_z = (depth**2 - groundhyp ** 2) ** .5
-        #print(math.atan(y/center_depth))
-        #print(groundhyp)
-        real_y = (groundhyp ** 2 - x ** 2) ** .5
-        return x + offset_x, real_y + offset_y, real_z - offset_z
-
-def checkTubeLocationValidity(realWorldCords):
-    match = [0] * 5
-    threshold = 10
-    matchAmount = 0
-    result = (0, 0, 0, 0)
-    for i in range(5):
-        for j in range(5):
-            if j != i :
-                if abs(get3Dlocation(realWorldCords[i]) - get3Dlocation(realWorldCords[j])) < threshold:
-                    match[j] = 1
-        for k in range(5):
-            if match[k] == 1:
-                result = tuple(sum(x) for x in zip(result, realWorldCords[k]))
-                matchAmount+=1
-                match[k] = 0
-        if matchAmount >= 3:
-            result = tuple(sum(x) for x in zip(result, realWorldCords[i]))
-            result = tuple(x/(matchAmount+1) for x in result)
-            result = result[:2] + (-result[2],) + result[3:]
-            return result
-        else:
-            matchAmount = 0
-            result = (0, 0, 0, 0)
-    return -2
+    return tuple(mount.apply((x, y, depth)).tolist())
+
+def collectTubeLocation(vis, batchSize=3, consensus=None, maxSamples=10):
+    '''
+    Collects good samples until enough of them agree on the tube location
+    (see TubeConsensus) or maxSamples good samples were taken.
+    Returns the tube location tuple, -1 if no tube was seen, the camera
+    x (for turning) if depth kept failing, or -2 if the samples never agreed
+    '''
+    if consensus is None:
+        consensus = TubeConsensus()
+    with vis.timer.span('collect'):
+        return _collectTubeLocation(vis, batchSize, consensus, maxSamples)
 
-def collectTubeLocation(vis):
+def _collectTubeLocation(vis, batchSize, consensus, maxSamples):
     consecutiveBad = 0
     consecutiveNone = 0
-    good = 0
     cameraCords = 0
-    realWorldCords = []
-    while(good < 5 and consecutiveBad < 10 and consecutiveNone < 10):
-        data = vis.processOneFrame()
-        if(data[2] == - 1):
-            consecutiveNone+=1
-        elif(data[2] == 0):
-            consecutiveBad+=1
-            cameraCords+=data[0]/10
-        else:
-            realWorldCords.append(translateCoordinates(data[0], data[1], data[2]) + (data[3],))
-            #print(realWorldCords[good])
-            #realWorldCords.append(translateCoordinates(data[0],data[1],data[2]) + tuple(0))
-            good+=1
-            consecutiveBad = 0
-            consecutiveNone = 0
+    while(len(consensus) < maxSamples and consecutiveBad < 10 and consecutiveNone < 10):
+        # Run a whole batch of frames through the model at once, then walk
+        # the per-frame results in capture order
+        batch = vis.processFrames(batchSize)
+
+        # Move every good sample of the batch to robot coordinates in one go
+        good = [data for data in batch if data[2] > 0]
+        robotCords = iter(mount.apply([data[:3] for data in good]).tolist() if good else [])
+
+        for data in batch:
+            if(data[2] == - 1):
+                consecutiveNone+=1
+            elif(data[2] == 0):
+                consecutiveBad+=1
+                cameraCords+=data[0]/10
+            else:
+                consensus.add(tuple(next(robotCords)) + (data[3],))
+                consecutiveBad = 0
+                consecutiveNone = 0
+
+                # Stop as soon as enough samples agree
+                with vis.timer.span('consensus'):
+                    result = consensus.result()
+                if result is not None:
+                    return result
+            if(len(consensus) >= maxSamples or consecutiveBad >= 10 or consecutiveNone >= 10):
+                break
     if(consecutiveNone >= 10):
         return -1
     elif(consecutiveBad >= 10):
         return cameraCords
     else:
-        return checkTubeLocationValidity(realWorldCords)#tuple(x/5 for x in realWorldCords)
+        return -2
 
-def main():
-    # Initialize the I2C bus
-    i2c = Nano_I2CBus()
-    # Initialize the Vision System
-    vis = VisionSystem()
-    
-    # Send ready command to Pi
-    i2c.write_pkt('Ready'.encode(), 'd', 0)
+def parseImageOptions(data):
+    '''
+    Parses an img command, e.g. 'img w=320 q=50 fmt=webp gray crop=30 win'.
+    Returns a dict of option -> value ('' for flags), including the command
+    itself
+    '''
+    options = {}
+    for token in data.split():
+        key, _, value = token.partition('=')
+        options[key] = value
+    return options
+
+def numericOption(options, key, low, high, default=None):
+    '''
+    Value of an img option as an int between low and high, default when
+    the option has no value. Raises ValueError for anything else
+    '''
+    value = options.get(key)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'img option {key}={value} is not a number') from None
+    if not low <= number <= high:
+        raise ValueError(f'img option {key}={value} is outside {low}-{high}')
+    return number
+
+def encodeImage(vis, color_image, options):
+    '''
+    Shrinks the img payload as the options ask:
+        crop[=margin]   only the last detected tube box plus margin pixels
+        gray            single channel
+        w=<pixels>      resize to this width, keeping the aspect ratio
+        q=<1-100>       encoder quality
+        fmt=jpg|webp    encoder
+    Returns the encoded bytes and the file extension, raises ValueError
+    for an invalid option
+    '''
+    # Check every option before any work is done
+    margin = numericOption(options, 'crop', 0, 10000, default=20)
+    targetWidth = numericOption(options, 'w', 1, 10000)
+    quality = numericOption(options, 'q', 1, 100)
+
+    image = color_image
+    if 'crop' in options and vis.lastBox is not None:
+        x1, y1, x2, y2 = vis.lastBox
+        height, width = image.shape[:2]
+        image = image[max(y1 - margin, 0):min(y2 + margin, height),
+                      max(x1 - margin, 0):min(x2 + margin, width)]
+
+    if 'gray' in options:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    if targetWidth is not None:
+        targetHeight = max(1, round(image.shape[0] * targetWidth / image.shape[1]))
+        image = cv2.resize(image, (targetWidth, targetHeight), interpolation=cv2.INTER_AREA)
+
+    params = []
+    if options.get('fmt') == 'webp':
+        extension = '.webp'
+        if quality is not None:
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        extension = '.JPG'
+        if quality is not None:
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError('Could not encode image')
+    return encoded.tobytes(), extension
+
+def formatTubeLocation(result):
+    '''
+    Turns a collectTubeLocation result into the cord reply
+    '''
+    if result == -2:
+        return 'error'
+    elif result == -1:
+        return 'none'
+    elif not isinstance(result, tuple):
+        return f'turn: {"left" if result < 0 else "right"}'
+    else:
+        s = "x{:.1f}y{:.1f}z{:.1f}a{:.1f}"
+        return s.format(*result)
+
+def cordOutcome(response):
+    '''
+    Metric name of a cord reply: none, error, turn or ok
+    '''
+    if response in ('none', 'error'):
+        return response
+    return 'turn' if response.startswith('turn') else 'ok'
+
+def saveImage(vis, i2c, data):
+    '''
+    Captures and encodes the image for an img command.
+    Returns the file name and the size to announce (None for a plain img)
+    '''
+    options = parseImageOptions(data)
+    result = vis.captureImage()
+    encoded, extension = encodeImage(vis, np.asanyarray(result[0].get_data()), options)
+
+    # timestamp the filename and create the image
+    filename = time.strftime("%Y%m%d-%H%M%S") + extension
+    with open(filename, 'wb') as image:
+        image.write(encoded)
+
+    # Report the payload size before sending it
+    size = len(encoded)
+    print(f'{filename}: {size} bytes')
+    i2c.write_log(f'{filename}: {size} bytes')
+
+    # A plain img keeps the old header so older Pi scripts still work
+    if data == 'img':
+        size = None
+    return filename, size
+
+class Dispatcher:
+    '''
+    Serves Pi commands without blocking the I2C loop.
+    The buffer keeps being polled while vision work (cord and img) runs on
+    a single worker thread, so the model is only ever run by one thread. A
+    cord command is acknowledged right away with an 'a' packet and answered
+    with a 'd' packet once the location is ready. Replies carry the
+    sequence number of the command they answer.
+
+    With a cache (see BackgroundDetector) cord is answered at once when the
+    cached location is at most maxAge seconds old, otherwise with the next
+    location the background detector produces. The detector then runs the
+    model on its own thread while img runs on the worker. That is safe
+    because img never touches the model: it takes its frame from the
+    capture thread's buffer (VisionSystem.latestFrames, behind a lock) and
+    only reads the last detected box.
+    '''
 
-    while True:
-        # wait for packet to be recieved
-        pkt = i2c.wait_response()
+    def __init__(self, i2c, vis, cache=None, maxAge=1.0, cacheTimeout=30.0):
+        self.i2c = i2c
+        self.vis = vis
+        self.cache = cache
+        self.maxAge = maxAge
+        self.cacheTimeout = cacheTimeout
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.metrics = i2c.metrics
 
-        if not pkt:
-            continue
+        # Sequence number -> task for cord commands still being worked on
+        self.pending = {}
 
+    async def run(self):
+        # Held while something writes to the buffer or a file transfer
+        # owns the link. Created here so it belongs to the running loop
+        self.bus = asyncio.Lock()
+
+        # Dump the metrics on demand with `kill -USR1 <pid>`. Run as a loop
+        # callback, a plain signal handler could interrupt count() on this
+        # thread while it holds the metrics lock
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, lambda: print(self.metrics.render()))
+
+        while True:
+            async with self.bus:
+                pkt = self.i2c.poll_pkt()
+            if pkt:
+                self.i2c.backoff.reset()
+                await self.handle(pkt)
+            else:
+                await asyncio.sleep(self.i2c.backoff.delay())
+
+            # Periodically export the metrics and log the stage latencies
+            self.metrics.exportIfDue()
+
+    async def handle(self, pkt):
         # If the packet isn't the target ID (pi) and it isn't a command
-        if (pkt[I2CPacket.id_index].decode() != i2c.pkt_targ_id) or (pkt[I2CPacket.stat_index] != b'c'):
-            continue
+        if (pkt[I2CPacket.id_index].decode() != self.i2c.pkt_targ_id) or (pkt[I2CPacket.stat_index] != b'c'):
+            return
 
         print('Command received:')
 
         data = pkt[I2CPacket.data_index].decode().strip('\0')
+        sequence = pkt[I2CPacket.seq_index]
         print(data)
-        
-        # Read command and respond back to Pi
-        if data == 'cord':
-            result = collectTubeLocation(vis)
-            if result == -2:
-                response = 'error'.encode()
-            elif result == -1:
-                response = 'none'.encode()
-            elif not isinstance(result, tuple):
-                response = (f'turn: {"left" if result < 0 else "right"}').encode()
-            else:
-                s = "x{:.1f}y{:.1f}z{:.1f}a{:.1f}"
-                response = s.format(*result)
-            
-            # Reply back to the Pi with a given response
-            i2c.write_pkt(response.encode(), 'd', 0)
-            print(response)
-                
-        elif data ==  'img':
-            result = vis.captureImage()
-            
-            # timestamp the filename and create the image
-            filename = time.strftime("%Y%m%d-%H%M%S") + '.JPG'
-            cv2.imwrite(filename, np.asanyarray(result[0].get_data()))
-            
-            # send image to Pi
-            i2c.file_send(filename)
-                
+
+        command = data.split()[0] if data else ''
+        if command == 'cord':
+            # Answer straight from the cache when it is fresh enough
+            if self.cache is not None:
+                cached = self.cache.get(self.maxAge)
+                if cached is not None:
+                    response = formatTubeLocation(cached[0])
+                    self.recordCord(sequence, response, 0.0, 0, age=cached[1])
+                    await self.reply(sequence, response)
+                    return
+
+            # A repeated command that is still running is only acknowledged
+            if sequence not in self.pending:
+                self.pending[sequence] = asyncio.ensure_future(self.cord(sequence))
+            async with self.bus:
+                self.i2c.write_pkt(b'', 'a', sequence)
+
+        elif command in ('img', 'imgw'):
+            await self.image(sequence, data)
+
+        elif command == 'version':
+            # Protocol negotiation, the reply still goes out in the Pi's
+            # current framing and later packets follow the Pi's switch
+            await self.reply(sequence, f'version {LATEST_VERSION}')
+
         else: #Unkown Command
-            response = 'Command not recognized'.encode()
-            i2c.write_pkt(response, 'd', 0)
+            await self.reply(sequence, 'Command not recognized')
+
+    async def cord(self, sequence):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        frames = self.vis.framesCaptured
+        try:
+            if self.cache is not None:
+                # The background detector is already collecting, use its
+                # next result instead of competing for the camera
+                cached = await loop.run_in_executor(None, self.cache.wait, self.cacheTimeout)
+                result = cached[0] if cached is not None else -2
+            else:
+                result = await loop.run_in_executor(self.executor, collectTubeLocation, self.vis)
+            response = formatTubeLocation(result)
+        except Exception as e:
+            self.i2c.write_log('cord failed: ' + repr(e))
+            response = 'error'
+        finally:
+            del self.pending[sequence]
+
+        # The background detector keeps capturing, so its frames are not
+        # this command's
+        frames = 0 if self.cache is not None else self.vis.framesCaptured - frames
+        self.recordCord(sequence, response, time.monotonic() - start, frames)
+
+        # Reply back to the Pi with a given response
+        await self.reply(sequence, response)
+        print(response)
+
+    def recordCord(self, sequence, response, seconds, frames, age=None):
+        outcome = cordOutcome(response)
+        self.metrics.count('cord_' + outcome)
+        self.metrics.count('cord_frames', frames)
+        self.metrics.timer.record('cord', seconds)
+        self.metrics.event('cord', seq=sequence, outcome=outcome, seconds=round(seconds, 4),
+                           frames=frames, cached_age=age)
+
+    async def image(self, sequence, data):
+        loop = asyncio.get_running_loop()
+        try:
+            filename, size = await loop.run_in_executor(self.executor, saveImage,
+                                                        self.vis, self.i2c, data)
+        except Exception as e:
+            # Bad options or no frame, the Pi gets 'error' instead of a file
+            self.i2c.write_log('img failed: ' + repr(e))
+            self.metrics.count('img_errors')
+            await self.reply(sequence, 'error')
+            return
+
+        # The transfer is a conversation of its own, so it owns the link
+        # until it is done. imgw / win use the windowed transfer
+        options = parseImageOptions(data)
+        if 'imgw' in options or 'win' in options:
+            send = self.i2c.file_send_windowed
+        else:
+            send = self.i2c.file_send
+        async with self.bus:
+            await loop.run_in_executor(None, send, filename, size)
+
+    async def reply(self, sequence, response):
+        async with self.bus:
+            # Take in anything the Pi just wrote before overwriting it
+            pkt = self.i2c.poll_pkt()
+            self.i2c.write_pkt(response.encode(), 'd', sequence)
+        if pkt:
+            await self.handle(pkt)
+
+def main(frameSource=None, background=False, maxAge=1.0):
+    # Counters, timings and the event log (logfile, metrics.txt)
+    metrics = Metrics()
+    # Initialize the I2C bus
+    i2c = Nano_I2CBus(metrics)
+    # Initialize the Vision System, keeping the camera streaming between commands
+    # Nothing is displayed here, so skip drawing the detections.
+    # The tube barely moves between cord samples, so after the first hit
+    # only a crop around it is run through the network
+    vis = VisionSystem(continuous=True, headless=True, frameSource=frameSource,
+                       roiPadding=0.5, timer=metrics.timer)
+
+    # Optionally keep detecting in the background and answer from a cache
+    cache = None
+    if background:
+        cache = DetectionCache()
+        BackgroundDetector(vis, collectTubeLocation, cache, metrics=metrics).start()
+
+    # Send ready command to Pi
+    i2c.write_pkt('Ready'.encode(), 'd', 0)
 
-        time.sleep(2)
+    asyncio.run(Dispatcher(i2c, vis, cache, maxAge).run())
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Jetson vision controller')
+    parser.add_argument('--background', action='store_true',
+                        help='detect continuously and answer cord from the latest result')
+    parser.add_argument('--max-age', type=float, default=1.0,
+                        help='oldest cached result (seconds) cord answers with')
+    args = parser.parse_args()
+    main(background=args.background, maxAge=args.max_age)
@@ -0,0 +1,98 @@
+import time
+import threading
+from consensus import TubeConsensus
+
+
+class DetectionCache:
+    '''
+    Latest tube location found by the background detector, stamped with
+    the time it was produced and the number of samples that agreed on it
+    '''
+
+    def __init__(self):
+        self.updated = threading.Condition()
+        self.result = None
+        self.timestamp = 0.0
+        self.samples = 0
+        self.version = 0
+
+    def update(self, result, samples):
+        with self.updated:
+            self.result = result
+            self.samples = samples
+            self.timestamp = time.monotonic()
+            self.version += 1
+            self.updated.notify_all()
+
+    def get(self, maxAge):
+        '''
+        Returns (result, age, samples) if the latest result is at most
+        maxAge seconds old, None otherwise
+        '''
+        with self.updated:
+            age = time.monotonic() - self.timestamp
+            if self.version == 0 or age > maxAge:
+                return None
+            return self.result, age, self.samples
+
+    def wait(self, timeout):
+        '''
+        Blocks until the next result comes in, returns (result, age, samples)
+        or None if nothing arrived within timeout seconds
+        '''
+        with self.updated:
+            version = self.version
+            if not self.updated.wait_for(lambda: self.version != version, timeout):
+                return None
+            return self.result, time.monotonic() - self.timestamp, self.samples
+
+
+class BackgroundDetector:
+    '''
+    Runs the cord collection (collect(vis, consensus=...)) back to back on
+    its own thread and keeps a DetectionCache filled with the results.
+    A failed collection is counted and logged to metrics (if given) and
+    the loop carries on after errorWait seconds
+    '''
+
+    def __init__(self, vis, collect, cache, interval=0.0, metrics=None, errorWait=0.5):
+        self.vis = vis
+        self.collect = collect
+        self.cache = cache
+        self.interval = interval
+        self.metrics = metrics
+        self.errorWait = errorWait
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        while self.running:
+            consensus = TubeConsensus()
+            try:
+                result = self.collect(self.vis, consensus=consensus)
+            except RuntimeError:
+                # No frames from the camera, try again
+                continue
+            except Exception as e:
+                # Keep the cache alive, the next collection may work
+                if self.metrics is not None:
+                    self.metrics.count('background_errors')
+                    self.metrics.event('background_error', error=repr(e))
+                time.sleep(self.errorWait)
+                continue
+            self.cache.update(result, consensus.count)
+            if self.interval:
+                time.sleep(self.interval)
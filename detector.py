@@ -0,0 +1,286 @@
+'''
+Detector backends. All of them are called like the YOLOv5 hub model:
+    results = detector(images)     # a list of HxWx3 images
+    results.xyxy[i]                # rows of x1, y1, x2, y2, conf, class
+    results.render()               # draws the boxes into results.ims
+and honour detector.classes to keep only some class ids.
+
+    torch   the YOLOv5 hub model (cached, see loadModel)
+    onnx    the same weights exported to ONNX, run with ONNX Runtime
+    opencv  the same ONNX file run with OpenCV DNN
+The ONNX backends do their own letterboxing and NMS in NumPy, so they need
+neither torch nor the YOLOv5 repo at run time.
+
+Export weights with: python3 detector.py best.pt [--quantize]
+'''
+import os
+import sys
+import hashlib
+import argparse
+import numpy as np
+import cv2
+
+
+def weightsHash(path):
+    '''
+    Short sha256 of a weights file, used to key the model cache
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as weights:
+        for block in iter(lambda: weights.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def loadModel(directoryOfNNWeights, nameOfWeights, cacheDir=None):
+    '''
+    Loads the YOLOv5 model for a weights file. The first load goes through
+    torch.hub and saves the ready to run model into cacheDir, keyed by the
+    hash of the weights. Later boots load that file directly and skip the
+    hub machinery; changing the weights file changes the key.
+    '''
+    import torch
+
+    if cacheDir is None:
+        cacheDir = os.path.join(directoryOfNNWeights, '.model_cache')
+    stem = os.path.splitext(os.path.basename(nameOfWeights))[0]
+    cachePath = os.path.join(cacheDir, stem + '-' + weightsHash(nameOfWeights) + '.pt')
+
+    # The saved model refers to the YOLOv5 repo's modules
+    if directoryOfNNWeights not in sys.path:
+        sys.path.insert(0, directoryOfNNWeights)
+
+    if os.path.exists(cachePath):
+        try:
+            return torch.load(cachePath)
+        except Exception as e:
+            print('Ignoring unreadable model cache ' + cachePath + ': ' + repr(e))
+
+    model = torch.hub.load(directoryOfNNWeights, 'custom',
+                           path=nameOfWeights,
+                           source='local')
+
+    # Write to a temporary name first so a power cut never leaves half a cache
+    os.makedirs(cacheDir, exist_ok=True)
+    torch.save(model, cachePath + '.tmp')
+    os.replace(cachePath + '.tmp', cachePath)
+    return model
+
+
+def exportOnnx(directoryOfNNWeights, nameOfWeights, onnxPath=None, imgsz=640,
+               quantize=False):
+    '''
+    Exports YOLOv5 weights to ONNX (dynamic batch and input size, traced
+    at imgsz x imgsz).
+    With quantize the weights are also int8 quantized with ONNX Runtime
+    and the quantized file is returned.
+    '''
+    import torch
+
+    if onnxPath is None:
+        onnxPath = os.path.splitext(nameOfWeights)[0] + '.onnx'
+
+    hubModel = loadModel(directoryOfNNWeights, nameOfWeights)
+    model = hubModel.model.model.float().cpu().eval()
+
+    # Make the Detect head return only the concatenated predictions
+    for module in model.modules():
+        if type(module).__name__ == 'Detect':
+            module.inplace = False
+            module.export = True
+
+    dummy = torch.zeros(1, 3, imgsz, imgsz)
+    torch.onnx.export(model, dummy, onnxPath, opset_version=12,
+                      input_names=['images'], output_names=['output0'],
+                      dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'output0': {0: 'batch', 1: 'anchors'}})
+
+    # Keep the class names with the model when the onnx package is around
+    try:
+        import onnx
+        exported = onnx.load(onnxPath)
+        names = hubModel.names
+        if isinstance(names, list):
+            names = dict(enumerate(names))
+        meta = exported.metadata_props.add()
+        meta.key, meta.value = 'names', repr(names)
+        onnx.save(exported, onnxPath)
+    except ImportError:
+        pass
+
+    if not quantize:
+        return onnxPath
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantPath = os.path.splitext(onnxPath)[0] + '-int8.onnx'
+    quantize_dynamic(onnxPath, quantPath, weight_type=QuantType.QUInt8)
+    return quantPath
+
+
+def letterbox(image, size):
+    '''
+    Resizes an image to fit a size x size square keeping its aspect ratio
+    and pads the rest with gray, like YOLOv5 does.
+    Returns the square image, the scale and the left / top padding
+    '''
+    height, width = image.shape[:2]
+    scale = min(size / height, size / width)
+    newHeight, newWidth = round(height * scale), round(width * scale)
+    if (newHeight, newWidth) != (height, width):
+        image = cv2.resize(image, (newWidth, newHeight), interpolation=cv2.INTER_LINEAR)
+
+    top, left = (size - newHeight) // 2, (size - newWidth) // 2
+    padded = np.full((size, size, 3), 114, np.uint8)
+    padded[top:top + newHeight, left:left + newWidth] = image
+    return padded, scale, left, top
+
+
+def nms(boxes, scores, iou):
+    '''
+    Greedy non maximum suppression, returns the kept indices by score
+    '''
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        height = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        inter = width * height
+        order = rest[inter / (areas[best] + areas[rest] - inter + 1e-9) <= iou]
+    return np.array(keep, np.intp)
+
+
+def postprocess(pred, conf, iou, classes=None, maxDet=300):
+    '''
+    Raw YOLOv5 predictions (N, 5 + classes) of one image to detection rows
+    x1, y1, x2, y2, conf, class in network input pixels
+    '''
+    pred = pred[pred[:, 4] > conf]
+    scores = pred[:, 5:] * pred[:, 4:5]
+    cls = scores.argmax(axis=1)
+    score = scores[np.arange(len(cls)), cls]
+
+    keep = score > conf
+    if classes is not None:
+        keep &= np.isin(cls, classes)
+    pred, cls, score = pred[keep], cls[keep], score[keep]
+    if not len(pred):
+        return np.zeros((0, 6), np.float32)
+
+    # Center, width, height to corners
+    boxes = np.empty((len(pred), 4), np.float32)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+    # Offset every class so boxes of different classes never suppress each other
+    kept = nms(boxes + cls[:, None] * 4096.0, score, iou)[:maxDet]
+    return np.concatenate((boxes[kept], score[kept, None], cls[kept, None]), axis=1).astype(np.float32)
+
+
+class Detections:
+    '''
+    Results of the ONNX backends, shaped like the YOLOv5 hub results
+    '''
+
+    def __init__(self, ims, xyxy, names):
+        self.ims = ims
+        self.xyxy = xyxy
+        self.names = names
+
+    def render(self):
+        for im, detections in zip(self.ims, self.xyxy):
+            for x1, y1, x2, y2, conf, cls in detections:
+                label = f'{self.names.get(int(cls), int(cls))} {conf:.2f}'
+                cv2.rectangle(im, (int(x1), int(y1)), (int(x2), int(y2)), (0, 0, 255), 2)
+                cv2.putText(im, label, (int(x1), max(int(y1) - 4, 10)),
+                            cv2.FONT_HERSHEY_SIMPLEX, .5, (0, 0, 255), 1)
+        return self.ims
+
+
+class OnnxDetector:
+    '''
+    YOLOv5 ONNX model run with ONNX Runtime on the CPU (or OpenCV DNN with
+    useOpenCV). Images are passed to the network in the same channel order
+    as the torch backend receives them.
+    '''
+
+    def __init__(self, onnxPath, imgsz=640, conf=0.25, iou=0.45, names=None,
+                 useOpenCV=False):
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.classes = None
+        self.useOpenCV = useOpenCV
+
+        if useOpenCV:
+            self.net = cv2.dnn.readNetFromONNX(onnxPath)
+            meta = {}
+        else:
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(onnxPath, providers=['CPUExecutionProvider'])
+            self.input = self.session.get_inputs()[0].name
+            meta = self.session.get_modelmeta().custom_metadata_map
+
+        if names is None and 'names' in meta:
+            import ast
+            names = ast.literal_eval(meta['names'])
+        self.names = names or {}
+
+    def __call__(self, images, size=None):
+        if isinstance(images, np.ndarray):
+            images = [images]
+        size = size or self.imgsz
+
+        boxed = [letterbox(image, size) for image in images]
+        batch = np.stack([padded for padded, _, _, _ in boxed])
+        batch = batch.transpose(0, 3, 1, 2).astype(np.float32) / 255
+
+        if self.useOpenCV:
+            self.net.setInput(batch)
+            preds = self.net.forward()
+        else:
+            preds = self.session.run(None, {self.input: batch})[0]
+
+        xyxy = []
+        for image, pred, (_, scale, left, top) in zip(images, preds, boxed):
+            detections = postprocess(pred, self.conf, self.iou, self.classes)
+
+            # Back to the original image's pixels
+            detections[:, [0, 2]] = np.clip((detections[:, [0, 2]] - left) / scale, 0, image.shape[1])
+            detections[:, [1, 3]] = np.clip((detections[:, [1, 3]] - top) / scale, 0, image.shape[0])
+            xyxy.append(detections)
+        return Detections(list(images), xyxy, self.names)
+
+
+def loadDetector(backend, directoryOfNNWeights, nameOfWeights, quantize=False):
+    '''
+    Returns the detector for a backend ('torch', 'onnx' or 'opencv').
+    The ONNX backends use the .onnx file next to the weights, exporting it
+    first if it does not exist yet (that step needs torch)
+    '''
+    if backend == 'torch':
+        return loadModel(directoryOfNNWeights, nameOfWeights)
+
+    onnxPath = os.path.splitext(nameOfWeights)[0] + ('-int8.onnx' if quantize else '.onnx')
+    if not os.path.exists(onnxPath):
+        onnxPath = exportOnnx(directoryOfNNWeights, nameOfWeights, quantize=quantize)
+
+    if backend == 'onnx':
+        return OnnxDetector(onnxPath)
+    if backend == 'opencv':
+        return OnnxDetector(onnxPath, useOpenCV=True)
+    raise ValueError('Unknown detector backend ' + backend)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export YOLOv5 weights to ONNX')
+    parser.add_argument('weights', help='.pt weights file')
+    parser.add_argument('--weights-dir', default='/home/herbie/OVision2022/yolov5',
+                        help='YOLOv5 repo used to load the weights')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--quantize', action='store_true', help='also write an int8 model')
+    args = parser.parse_args()
+    print(exportOnnx(args.weights_dir, args.weights, imgsz=args.imgsz, quantize=args.quantize))
@@ -1,27 +1,45 @@
 import cv2
-from math import atan, degrees
+from math import atan2, degrees
+
+# Print the scan results on every call
+DEBUG = False
+
+# Extra pixels around the box handed to Canny so the gradients at the
+# box border match the ones computed on the full frame
+MARGIN = 8
+
 #top left (x,y) representing top left corner of tube box
 #bottom right (x,y) same as above
 #center (x,y) same as above
 def get_degrees(top_left, bottom_right, center, img):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = img.shape[:2]
+    x0, y0 = max(top_left[0] - MARGIN, 0), max(top_left[1] - MARGIN, 0)
+    x1 = min(bottom_right[0] + MARGIN, width)
+    y1 = min(bottom_right[1] + MARGIN, height)
+
+    # Only convert and run edge detection on the box crop
+    gray = cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
     img_out = cv2.Canny(gray, 100, 150)
+
+    # Scan the box column by column, top to bottom, for the first edge pixel
+    box = img_out[top_left[1] - y0:bottom_right[1] - y0,
+                  top_left[0] - x0:bottom_right[0] - x0]
+    edges = box.T > 0
     first_white_col, first_white_row = top_left[1], top_left[0]
     done = 0
-    for row in range(top_left[0], bottom_right[0]):
-        for col in range(top_left[1], bottom_right[1]):
-            if img_out[col][row] > 0:
-                first_white_col, first_white_row = col, row
-                done = 1
-                break
-        if done:
-            break
-    
-    tan_triangle = abs(center[1] - first_white_col) / abs(center[0] - first_white_row)
-    degrees_off_axis =  90 - degrees(atan(tan_triangle))
+    if edges.size:
+        hit = int(edges.argmax())
+        if edges.flat[hit]:
+            row, col = divmod(hit, edges.shape[1])
+            first_white_col, first_white_row = top_left[1] + col, top_left[0] + row
+            done = 1
+
+    degrees_off_axis = 90 - degrees(atan2(abs(center[1] - first_white_col),
+                                          abs(center[0] - first_white_row)))
     if(first_white_col > center[1]):
         degrees_off_axis = 180 - degrees_off_axis
-    print(f"First white pixel: {first_white_col} {first_white_row}")
-    print(f"Center: {center[0]}, {center[1]}")
-    print(f"Degrees from y-axis = {degrees_off_axis} and {done}")
+    if DEBUG:
+        print(f"First white pixel: {first_white_col} {first_white_row}")
+        print(f"Center: {center[0]}, {center[1]}")
+        print(f"Degrees from y-axis = {degrees_off_axis} and {done}")
     return(degrees_off_axis)
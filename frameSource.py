@@ -0,0 +1,280 @@
+#boot pathing
+import sys
+sys.path.append(".")
+sys.path.append("/usr/local/lib")
+sys.path.append("/usr/local/lib/python3.8/pyrealsense2")
+
+import os
+import glob
+import time
+import datetime
+from types import SimpleNamespace
+import numpy as np
+import cv2
+
+# pyrealsense2 is only needed for the live camera, recordings can be
+# replayed on machines without librealsense installed
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
+
+class FrameSource:
+    '''
+    Interface for anything that hands out color + depth framesets.
+    Framesets follow the pyrealsense2 API that the vision code relies on:
+        frames.get_color_frame().get_data()     -> HxWx3 bgr8 image
+        frames.get_depth_frame().get_data()     -> HxW z16 image
+        frames.get_depth_frame().get_distance(x, y) -> meters
+        frames.keep()
+    get_intrinsics returns the depth stream intrinsics (width, height, fx,
+    fy, ppx, ppy, coeffs) once the source is started.
+    Recordings carry on where they were after stop() and start(), rewind()
+    goes back to their first frame. close() releases the source for good.
+    '''
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def rewind(self):
+        pass
+
+    def close(self):
+        pass
+
+    def wait_for_frames(self):
+        raise NotImplementedError
+
+    def get_intrinsics(self):
+        raise NotImplementedError
+
+
+class RealSenseSource(FrameSource):
+    '''
+    Live D405 stream, or playback of a RealSense .bag recording
+    '''
+
+    def __init__(self, width=640, height=480, fps=30, bagFile=None,
+                 realtime=True, loop=True):
+        if rs is None:
+            raise ImportError('pyrealsense2 is required for RealSenseSource')
+        self.pipeline = rs.pipeline()
+        self.config = rs.config()
+        self.realtime = realtime
+        self.bagFile = bagFile
+        self.profile = None
+        self.playback = None
+
+        if bagFile is not None:
+            self.config.enable_device_from_file(bagFile, repeat_playback=loop)
+
+        self.config.enable_stream(rs.stream.depth, width, height, rs.format.z16, fps)
+        self.config.enable_stream(rs.stream.color, width, height, rs.format.bgr8, fps)
+
+    def start(self):
+        # Paused bag playback carries on where it stopped
+        if self.playback is not None:
+            self.playback.resume()
+            return self.profile
+
+        self.profile = self.pipeline.start(self.config)
+        if self.bagFile is not None:
+            self.playback = self.profile.get_device().as_playback()
+            # Let bag playback run as fast as the consumer reads it
+            if not self.realtime:
+                self.playback.set_real_time(False)
+        return self.profile
+
+    def stop(self):
+        # Restarting the pipeline would rewind the bag, so it is only paused
+        if self.playback is not None:
+            self.playback.pause()
+        else:
+            self.pipeline.stop()
+
+    def rewind(self):
+        if self.playback is not None:
+            self.playback.seek(datetime.timedelta(0))
+
+    def close(self):
+        # A live stream is stopped by stop(), paused playback only here
+        if self.playback is not None:
+            self.playback = None
+            self.pipeline.stop()
+
+    def wait_for_frames(self):
+        return self.pipeline.wait_for_frames()
+
+    def get_intrinsics(self):
+        stream = self.profile.get_stream(rs.stream.depth)
+        return stream.as_video_stream_profile().get_intrinsics()
+
+
+class RecordedFrame:
+    '''
+    Stand-in for a pyrealsense2 video/depth frame backed by a numpy array
+    '''
+
+    def __init__(self, data, units=0.0001):
+        self.data = data
+        self.units = units
+
+    def get_data(self):
+        return self.data
+
+    def get_distance(self, x, y):
+        return float(self.data[y, x]) * self.units
+
+    def get_units(self):
+        return self.units
+
+    def keep(self):
+        pass
+
+    def __bool__(self):
+        return True
+
+
+class RecordedFrameset:
+    def __init__(self, color, depth, units):
+        # Copy so drawing on the image never alters the recording
+        self.color_frame = RecordedFrame(color.copy())
+        self.depth_frame = RecordedFrame(depth, units)
+
+    def get_color_frame(self):
+        return self.color_frame
+
+    def get_depth_frame(self):
+        return self.depth_frame
+
+    def keep(self):
+        pass
+
+
+class ReplaySource(FrameSource):
+    '''
+    Replays a recorded session of color + depth pairs.
+    path can be:
+        an .npz file with 'color' (N,H,W,3), 'depth' (N,H,W) and optionally
+            'depth_units' (meters per depth unit) and 'intrinsics' (width,
+            height, fx, fy, ppx, ppy, coeffs...) arrays, as written by
+            recordSession
+        a directory with color_XXXX.png and depth_XXXX.npy pairs
+    fps paces the replay, None replays as fast as frames are requested.
+    The replay keeps its position across stop() and start().
+    '''
+
+    def __init__(self, path, fps=None, loop=True, depthUnits=0.0001):
+        self.fps = fps
+        self.loop = loop
+        self.depthUnits = depthUnits
+        self.intrinsics = None
+        self.colors, self.depths = self.load(path)
+        self.index = 0
+        self.nextTime = 0
+
+    def load(self, path):
+        if os.path.isdir(path):
+            colorFiles = sorted(glob.glob(os.path.join(path, 'color_*.png')))
+            colors, depths = [], []
+            for colorFile in colorFiles:
+                frameId = os.path.basename(colorFile)[len('color_'):-len('.png')]
+                colors.append(cv2.imread(colorFile, cv2.IMREAD_COLOR))
+                depths.append(np.load(os.path.join(path, 'depth_' + frameId + '.npy')))
+        else:
+            recording = np.load(path)
+            colors, depths = list(recording['color']), list(recording['depth'])
+            if 'depth_units' in recording:
+                self.depthUnits = float(recording['depth_units'])
+            if 'intrinsics' in recording:
+                values = recording['intrinsics']
+                self.intrinsics = SimpleNamespace(
+                    width=int(values[0]), height=int(values[1]),
+                    fx=float(values[2]), fy=float(values[3]),
+                    ppx=float(values[4]), ppy=float(values[5]),
+                    coeffs=[float(v) for v in values[6:]])
+
+        if not colors:
+            raise ValueError('No recorded frames found in ' + path)
+        return colors, depths
+
+    def start(self):
+        self.nextTime = time.perf_counter()
+
+    def rewind(self):
+        self.index = 0
+
+    def wait_for_frames(self, timeout_ms=5000):
+        if self.index >= len(self.colors):
+            if not self.loop:
+                # Behave like a camera that stopped delivering frames
+                time.sleep(timeout_ms / 1000)
+                raise RuntimeError('Frame didn\'t arrive within ' + str(timeout_ms))
+            self.index = 0
+
+        # Hold the frame back until it is due at the requested rate
+        if self.fps:
+            now = time.perf_counter()
+            if self.nextTime > now:
+                time.sleep(self.nextTime - now)
+                now = self.nextTime
+            self.nextTime = now + 1 / self.fps
+
+        frames = RecordedFrameset(self.colors[self.index], self.depths[self.index],
+                                  self.depthUnits)
+        self.index += 1
+        return frames
+
+    def get_intrinsics(self):
+        if self.intrinsics is not None:
+            return self.intrinsics
+
+        # Older recordings: the values that used to be hard coded for the D405
+        height, width = self.depths[0].shape
+        return SimpleNamespace(width=width, height=height, fx=386.0, fy=386.0,
+                               ppx=width / 2, ppy=height / 2, coeffs=None)
+
+
+def openSource(path=None, fps=None, loop=True):
+    '''
+    Picks the frame source for a path: the live camera when no path is
+    given, RealSense playback for .bag files and ReplaySource otherwise
+    '''
+    if path is None:
+        return RealSenseSource()
+    if path.endswith('.bag'):
+        return RealSenseSource(bagFile=path, realtime=fps is not None, loop=loop)
+    return ReplaySource(path, fps=fps, loop=loop)
+
+
+def recordSession(source, filename, count):
+    '''
+    Grabs count framesets from source and stores them in an .npz file
+    that ReplaySource can play back
+    '''
+    colors, depths = [], []
+    units = 0.0001
+    source.start()
+    try:
+        intr = source.get_intrinsics()
+        intrinsics = [intr.width, intr.height, intr.fx, intr.fy, intr.ppx, intr.ppy]
+        intrinsics += list(intr.coeffs or [])
+        for _ in range(count):
+            frames = source.wait_for_frames()
+            depth_frame = frames.get_depth_frame()
+            colors.append(np.array(frames.get_color_frame().get_data()))
+            depths.append(np.array(depth_frame.get_data()))
+            units = depth_frame.get_units()
+    finally:
+        source.stop()
+    np.savez_compressed(filename, color=np.stack(colors), depth=np.stack(depths),
+                        depth_units=units, intrinsics=np.array(intrinsics, np.float64))
+
+
+if __name__ == '__main__':
+    # Record a session from the camera: python3 frameSource.py out.npz 100
+    recordSession(RealSenseSource(), sys.argv[1], int(sys.argv[2]))
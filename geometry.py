@@ -0,0 +1,85 @@
+import math
+import numpy as np
+import cv2
+
+
+class CameraGeometry:
+    '''
+    Turns pixels + depth into camera coordinates using the stream intrinsics
+    (x right, y down, z forward, same units as the depth).
+    The normalized ray (x/z, y/z) of every pixel is computed once, including
+    lens distortion when the intrinsics have coefficients, so deprojecting
+    is a table lookup and a multiply for any number of pixels.
+    '''
+
+    def __init__(self, width, height, fx, fy, ppx, ppy, coeffs=None):
+        self.width = width
+        self.height = height
+        self.fx, self.fy = fx, fy
+        self.ppx, self.ppy = ppx, ppy
+
+        if coeffs is not None and any(coeffs):
+            # Undistort every pixel center once with OpenCV
+            pixels = np.stack(np.meshgrid(np.arange(width), np.arange(height)),
+                              axis=-1).reshape(-1, 1, 2).astype(np.float32)
+            cameraMatrix = np.array([[fx, 0, ppx], [0, fy, ppy], [0, 0, 1]])
+            rays = cv2.undistortPoints(pixels, cameraMatrix, np.asarray(coeffs, np.float64))
+            self.rays = rays.reshape(height, width, 2).astype(np.float32)
+        else:
+            self.rays = np.empty((height, width, 2), np.float32)
+            self.rays[..., 0] = ((np.arange(width) - ppx) / fx)[None, :]
+            self.rays[..., 1] = ((np.arange(height) - ppy) / fy)[:, None]
+
+    @classmethod
+    def fromIntrinsics(cls, intrinsics):
+        '''
+        Builds the table from pyrealsense2 intrinsics (or anything with the
+        same width, height, fx, fy, ppx, ppy and coeffs attributes)
+        '''
+        return cls(intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy,
+                   intrinsics.ppx, intrinsics.ppy, getattr(intrinsics, 'coeffs', None))
+
+    def deproject(self, px, py, depth):
+        '''
+        Camera coordinates of pixels (px, py) at the given depth.
+        Takes scalars or arrays, returns an array with a last axis of x, y, z
+        '''
+        rays = self.rays[np.asarray(py, np.intp), np.asarray(px, np.intp)]
+        depth = np.asarray(depth, np.float64)
+        return np.stack((rays[..., 0] * depth, rays[..., 1] * depth, depth), axis=-1)
+
+    def deprojectImage(self, depth_image, scale=1.0):
+        '''
+        Camera coordinates of every pixel of a depth image, shape (H, W, 3).
+        scale converts depth units, e.g. depth_frame.get_units() * 100 for cm
+        '''
+        depth = depth_image.astype(np.float32) * scale
+        return np.concatenate((self.rays * depth[..., None], depth[..., None]), axis=-1)
+
+
+class RigidTransform:
+    '''
+    points -> points @ rotation.T + translation, for one point or an (N, 3)
+    array of points
+    '''
+
+    def __init__(self, rotation, translation):
+        self.rotation = np.asarray(rotation, np.float64)
+        self.translation = np.asarray(translation, np.float64)
+
+    def apply(self, points):
+        return np.asarray(points, np.float64) @ self.rotation.T + self.translation
+
+
+def cameraMount(angle, offsetX, offsetY, offsetZ):
+    '''
+    Camera to robot transform for a camera tilted angle radians up from
+    looking straight down. Robot axes are x right, y forward along the
+    ground and z down. The mount offsets (cm) are added to x and y and
+    subtracted from z.
+    '''
+    c, s = math.cos(angle), math.sin(angle)
+    rotation = [[1, 0, 0],
+                [0, -c, s],
+                [0, s, c]]
+    return RigidTransform(rotation, [offsetX, offsetY, -offsetZ])
@@ -0,0 +1,143 @@
+'''
+File transfer throughput of the I2C protocol over the simulated link
+(i2c_loopback), no Jetson or Pi needed:
+    python3 i2c_benchmark.py --size 20000 --error-rates 0 0.01 0.05 0.1 --bits 2
+Both sides run in this process on their own threads, exactly the code
+that runs on the robot (Nano_I2CBus.file_send[_windowed] and
+I2CBus.read_file[_windowed]).
+'''
+
+import os
+import time
+import argparse
+import tempfile
+import itertools
+import contextlib
+import threading
+from i2c_packet import I2CPacket, FRAMINGS
+from i2c_loopback import SharedBuffer
+from metrics import Metrics
+from Nano_I2C import Nano_I2CBus
+from i2c_bus import I2CBus
+
+
+def serve_file(jetson, filename, windowed, timeout=10.0):
+    '''
+    Waits for the Pi's command and sends it the file, like control.py
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pkt = jetson.poll_pkt()
+        if pkt and pkt[I2CPacket.stat_index] == b'c':
+            send = jetson.file_send_windowed if windowed else jetson.file_send
+            send(filename, os.path.getsize(filename))
+            return
+        time.sleep(jetson.backoff.delay())
+
+
+def run_transfer(payload, windowed, error_rate, latency, workdir,
+                 path=None, seed=0, version=1, bits=1):
+    '''
+    Sends payload from the Jetson to the Pi once over a fresh link.
+    Returns a dict of the measurements
+    '''
+    link = SharedBuffer(path, error_rate=error_rate, latency=latency, seed=seed, bits=bits)
+    metrics = Metrics(logFile=os.path.join(workdir, 'logfile'),
+                      metricsFile=os.path.join(workdir, 'metrics.txt'))
+    jetson = Nano_I2CBus(metrics, transport=link)
+    pi = I2CBus(device=link)
+
+    # Stream chunks at the Pi's poll rate over this link
+    jetson.pi_stream_wait = pi.stream_wait
+    jetson.pi_read_time = latency
+
+    # As if negotiated, the Jetson follows the framing of the Pi's packets
+    pi.codec = FRAMINGS[version]
+
+    # The Pi saves into its own directory, the Jetson sends from another
+    source = os.path.join(workdir, 'jetson', 'payload.bin')
+    received = os.path.join(workdir, 'pi', 'payload.bin')
+    for directory in (os.path.dirname(source), os.path.dirname(received)):
+        os.makedirs(directory, exist_ok=True)
+    with open(source, 'wb') as out:
+        out.write(payload)
+    if os.path.exists(received):
+        os.remove(received)
+
+    server = threading.Thread(target=serve_file, args=(jetson, source, windowed))
+    server.start()
+
+    start = time.perf_counter()
+    try:
+        if windowed:
+            done = pi.read_file_windowed('imgw', directory=os.path.dirname(received))
+        else:
+            done = pi.read_file('img', directory=os.path.dirname(received))
+    except OSError:
+        done = False
+    seconds = time.perf_counter() - start
+    server.join()
+
+    intact = False
+    if done and os.path.exists(received):
+        with open(received, 'rb') as result:
+            intact = result.read() == payload
+
+    counters = metrics.counters
+    metrics.close()
+    link.close()
+    return {
+        'ok': bool(done) and intact,
+        'corrupt': bool(done) and not intact,
+        'seconds': seconds,
+        'packets': link.writes,
+        'polls': link.reads,
+        'errors': link.errors,
+        'jetson_retries': (counters.get('i2c_resends', 0) + counters.get('i2c_resend_requests', 0) +
+                           counters.get('i2c_chunks_resent', 0)),
+        'pi_retries': pi.retries,
+        'timeouts': counters.get('i2c_timeouts', 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the I2C file transfer over a simulated link')
+    parser.add_argument('--size', type=int, default=10000, help='payload bytes')
+    parser.add_argument('--error-rates', type=float, nargs='+', default=[0.0, 0.01, 0.05, 0.1],
+                        help='probability of a flipped bit per transfer')
+    parser.add_argument('--latency', type=float, default=0.003,
+                        help='seconds per buffer read or write (256 bytes at 400 kHz is about 6 ms)')
+    parser.add_argument('--file', help='back the buffer with this file instead of memory')
+    parser.add_argument('--bits', type=int, default=1, help='bits flipped per injected error')
+    parser.add_argument('--versions', type=int, nargs='+', default=sorted(FRAMINGS),
+                        help='protocol versions (framings) to compare')
+    parser.add_argument('--runs', type=int, default=3, help='transfers per mode and error rate')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    # Totals over the runs; bytes/s only counts transfers that arrived intact
+    # corrupt counts transfers that finished with wrong data undetected
+    print(f'{"mode":9} {"v":>1} {"errors":>6} {"ok":>5} {"corrupt":>7} {"seconds":>8} {"packets/s":>9} '
+          f'{"bytes/s":>8} {"faults":>6} {"jetson retries":>14} {"pi retries":>10} {"timeouts":>8}')
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        for windowed, version, error_rate in itertools.product((False, True), args.versions,
+                                                               args.error_rates):
+            runs = []
+            for run in range(args.runs):
+                # Keep the transfers' progress messages out of the table
+                with contextlib.redirect_stdout(devnull):
+                    runs.append(run_transfer(payload, windowed, error_rate, args.latency,
+                                             workdir, args.file, args.seed + run,
+                                             version, args.bits))
+            total = {key: sum(stats[key] for stats in runs) for key in runs[0]}
+            seconds = total['seconds']
+            print(f'{"windowed" if windowed else "per-chunk":9} {version:1} {error_rate:6.3f} '
+                  f'{total["ok"]:>2}/{args.runs:<2} {total["corrupt"]:7} {seconds / args.runs:8.2f} '
+                  f'{total["packets"] / seconds:9.1f} {total["ok"] * args.size / seconds:8.0f} '
+                  f'{total["errors"]:6} {total["jetson_retries"]:14} '
+                  f'{total["pi_retries"]:10} {total["timeouts"]:8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,86 +4,17 @@ The Jetson's I2C address is hardcoded to 0x64 currently
 The Pi provides the I2C bus as a device: "/dev/i2c-1"
 '''
 
-import pylibi2c
+import os
 import time
-import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from i2c_packet import I2CPacket, Backoff, FRAMINGS, LATEST_VERSION
 
-class I2CPacket:
-    '''
-    Contains functions that aim to abstract away all the functionality
-    related to packets, mainly building it and verifying packet integrity
-
-    Packet structure:
-    Size of data                - Python type
-    245 byte for data           - bytes
-    1 byte for data length      - integer
-    1 byte for status messages  - bytes
-    4 bytes for parity          - integer
-    4 bytes for sequence number - integer
-    1 byte for sender ID        - bytes
-    '''
-
-    struct_format: str = '=245sBcIIc'
-    data_len: int = 245
-    data_index: int = 0
-    dlen_index: int = 1
-    stat_index: int = 2
-    par_index: int = 3
-    seq_index: int = 4
-    id_index: int = 5
-
-    def create_pkt(data: bytes, size: int, status: str,
-                   sequence: int, ID: str):
-        '''
-        Builds a packet containing the specified data. Adds in checksum.
-
-        Returns bytes object for writing.
-        '''
-        # Check lengths of input. Return false if packing cannot be done
-        if size > I2CPacket.data_len:
-            return False
-
-        # Create packet with zero checksum for calculation
-        pkt_array = bytearray(struct.pack(I2CPacket.struct_format,
-                                            data, size, status[:1].encode(),
-                                            0, sequence, ID[:1].encode()))
-
-        # Find checksum and stick individual bytes into place
-        pkt_array[247:251] = sum(pkt_array).to_bytes(4, 'little')
-
-        # Convert back into bytes object for returning
-        return bytes(pkt_array)
-
-    def parse_pkt(pkt: bytes):
-        '''
-        Unpacks packet, returns resulting tuple
-        '''
-        return struct.unpack(I2CPacket.struct_format, pkt)
-
-    def verify_pkt(pkt: bytes):
-        '''
-        Given a packet, calculates checksum, checks with provided checksum of
-        packet.
-
-        Returns True if they match, False if they do not.
-        '''
-        # Convert to byte array
-        pkt_array = bytearray(pkt)
-
-        # Extract checksum from packet
-        provided = int.from_bytes(pkt_array[247:251], 'little', signed=False)
-
-        # Substitute checksum with all zeros
-        pkt_array[247:251] = bytearray(4)
-
-        # Calculate checksum
-        calculated = sum(pkt_array)
-
-        # Return True if matching, False otherwise
-        if calculated == provided:
-            return True
-        else:
-            return False
+# Only needed for the real bus, i2c_loopback works without it
+try:
+    import pylibi2c
+except ImportError:
+    pylibi2c = None
 
 class I2CBus:
     '''
@@ -92,20 +23,40 @@ class I2CBus:
 
     blocksize: int = 256    # Max bytes capable of sending
     timewait: float = 0.2
+    stream_wait: float = 0.005  # Poll delay while chunks are being streamed
+    result_timeout: float = 30.0  # Time for the reply once acknowledged
+
+    spin_time: float = 0.005  # Poll without sleeping this long after a write
+    min_wait: float = 0.002   # First poll delay once spinning is over
 
     pkt_self_id: str = 'P'
     pkt_targ_id: str = 'J'
 
-    def __init__(self, target = 0x64, dev = '/dev/i2c-1'):
+    def __init__(self, target = 0x64, dev = '/dev/i2c-1', device = None):
         '''
         Initializes the bus using the imported library.
 
         Default device address for Jetson is 0x64
         Default device for I2C on Pi is i2c-1
+        device replaces the pylibi2c device, e.g. an i2c_loopback.SharedBuffer
         '''
         self.target = target # I2C address of the target (Jetson)
         self.dev = dev       # I2C bus being used on Pi
-        self.bus = pylibi2c.I2CDevice(self.dev, self.target)
+        if device is not None:
+            self.bus = device
+        elif pylibi2c is None:
+            raise ImportError('pylibi2c is needed to use the I2C bus')
+        else:
+            self.bus = pylibi2c.I2CDevice(self.dev, self.target)
+
+        # Poll quickly right after a write, slowing down to timewait
+        self.backoff = Backoff(self.spin_time, self.min_wait, self.timewait)
+
+        # Packets sent again because of errors or timeouts
+        self.retries = 0
+
+        # Framing of the packets we write, see negotiate
+        self.codec = I2CPacket
 
     def write_msg(self, data):
         '''
@@ -155,7 +106,7 @@ class I2CBus:
         Builds a packet around the requested data, sends it over I2C to the
         Jetson.
         '''
-        pkt = I2CPacket.create_pkt(data, len(data), status, sequence, self.pkt_self_id)
+        pkt = self.codec.create_pkt(data, len(data), status, sequence, self.pkt_self_id)
 
         # Return status of write
         return self.write_msg(pkt)
@@ -167,6 +118,7 @@ class I2CBus:
         '''
         # Timeout in 3 second
         timeout = time.time() + 3
+        self.backoff.reset()
 
         # Continuously check the Jetson for its response
         while timeout > time.time():
@@ -175,7 +127,7 @@ class I2CBus:
 
             # Check its integrity (checksum)
             if not I2CPacket.verify_pkt(data):
-                time.sleep(self.timewait)
+                time.sleep(self.backoff.delay())
                 continue
 
             # Parse packet if it is valid and return
@@ -214,15 +166,48 @@ class I2CBus:
                 if I2CPacket.verify_pkt(data):
                     return pkt
 
-            time.sleep(self.timewait)
+            time.sleep(self.backoff.delay())
 
         # If timeout occurs, return false
         return False
 
+    def wait_reply(self, sequence: int):
+        '''
+        Blocks until the Jetson answers the packet with this sequence number.
+        Slow commands are acknowledged first ('a') and answered once the
+        Jetson is done. Acks and replies carrying another sequence number
+        belong to some other request (e.g. a cord still pending when a file
+        is asked for) and are skipped
+
+        Returns the answer, false after 3 seconds without one or
+        result_timeout seconds after the ack without the reply
+        '''
+        timeout = time.time() + 3
+        acknowledged = False
+
+        while timeout > time.time():
+            result = self.wait_response()
+            if not result:
+                return False
+
+            status = result[I2CPacket.stat_index]
+            if status in (b'a', b'd') and result[I2CPacket.seq_index] != sequence:
+                pass
+            elif status == b'a':
+                if not acknowledged:
+                    acknowledged = True
+                    timeout = time.time() + self.result_timeout
+            else:
+                return result
+            time.sleep(self.backoff.delay())
+
+        return False
+
     def send_and_wait(self, data: bytes, status: str, sequence: int):
         '''
         Send a packet, make continuous reads, resend packets if receiver
-        sends an error message.
+        sends an error message. A missing answer (see wait_reply) uses up
+        one of the 5 attempts.
 
         Return false if an error occured (timeout or error writing)
         Return packet if non-error packet received
@@ -230,19 +215,22 @@ class I2CBus:
         i = 0
 
         # Create packet
-        pkt = I2CPacket.create_pkt(data, len(data), status, sequence,
-                                   self.pkt_self_id)
+        pkt = self.codec.create_pkt(data, len(data), status, sequence,
+                                    self.pkt_self_id)
         
         # Sent packet and wait for a response
         # Catch external IO errors 5 times before relenting
         while i < 5:
             # Write packet, return false if it fails
+            if i:
+                self.retries += 1
             if self.write_msg(pkt) < 0:
                 i += 1
                 continue
+            self.backoff.reset()
 
-            # Grab result of the wait
-            result = self.wait_response()
+            # Grab the answer to this packet
+            result = self.wait_reply(sequence)
 
             # If wait returns false, return false
             if not result:
@@ -253,7 +241,7 @@ class I2CBus:
             else:
                 # Resend packet if an error packet was received
                 if result[I2CPacket.stat_index] == b'e':
-                    pass
+                    self.retries += 1
 
                 # Return packet if non-error
                 else:
@@ -262,24 +250,54 @@ class I2CBus:
 
         raise OSError('Could not establish communication with device')
 
-    def read_file(self):
+    def negotiate(self):
+        '''
+        Asks the Jetson for the newest protocol version both sides know and
+        switches to its framing. A Jetson that does not know the command
+        keeps both on version 1.
+        Returns the version in use
+        '''
+        try:
+            pkt = self.send_and_wait(f'version {LATEST_VERSION}'.encode(), 'c', 0)
+        except OSError:
+            return self.codec.version
+        return self.accept_version(pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]].decode(errors='ignore'))
+
+    def accept_version(self, reply: str):
+        '''
+        Switches to the framing of a 'version N' reply, anything else (e.g.
+        'Command not recognized' from an older Jetson) keeps version 1
+        '''
+        words = reply.split()
+        if len(words) == 2 and words[0] == 'version' and words[1].isdigit():
+            self.codec = FRAMINGS.get(min(int(words[1]), LATEST_VERSION), I2CPacket)
+        else:
+            self.codec = I2CPacket
+        return self.codec.version
+
+    def read_file(self, cmd: str = 'img', directory: str = None):
         '''
         Reads the contents of a file from the Jetson. Works in tandem with the
             monitor on the Jetson's side of the comm channel, as we can only
             receive the file 256 bytes at a time.
+
+        cmd can carry image options, e.g. 'img w=320 q=50 gray crop=30'
+        directory, if given, is where the file is saved instead of the
+        path the Jetson names
         '''
         sequence = 0
         
         # Send command and wait for response with filename
-        cmd = 'img'
         pkt = self.send_and_wait(cmd.encode(), 'c', sequence)
         
         # Return false on packet error
         if not pkt:
             return False
         
-        # filename
-        file = pkt[I2CPacket.data_index].decode().strip('\0')
+        # filename, None if the Jetson could not make the file
+        file = self.file_header(pkt, directory)
+        if file is None:
+            return False
             
         print('Transmission starting')
 
@@ -294,6 +312,10 @@ class I2CBus:
                 # Return false on packet error
                 if not pkt:
                     return False
+
+                # The terminating packet carries no file data
+                if pkt[I2CPacket.stat_index] == b't':
+                    break
                 
                 # Grab relevant data
                 data = pkt[I2CPacket.data_index]
@@ -307,33 +329,345 @@ class I2CBus:
 
         return True  
 
-# Used for testing sending commands and recieving data with the jetson nano
-def main():
-    bus = I2CBus()
+    def file_header(self, pkt, directory: str = None):
+        '''
+        Returns the file name of the first packet of a transfer, printing
+        the size when the Jetson reports it ("name|size"). Returns None when
+        the Jetson answered 'error' instead (bad options or no frame)
+        '''
+        header = pkt[I2CPacket.data_index].decode().strip('\0')
+        if pkt[I2CPacket.stat_index] == b'd' and header == 'error':
+            print('Jetson could not capture the image')
+            return None
+        file, _, size = header.partition('|')
+        if size:
+            print(f'Receiving {file}: {size} bytes')
+        if directory is not None:
+            file = os.path.join(directory, os.path.basename(file))
+        return file
+
+    def read_file_windowed(self, cmd: str = 'imgw', directory: str = None):
+        '''
+        Reads a file sent with Nano_I2CBus.file_send_windowed. The Jetson
+        streams chunks without waiting for a reply, so the buffer is polled
+        quickly and every valid chunk is kept by sequence number. Only the
+        Jetson's end-of-window check is answered, with a bitmap of the
+        chunks that were missed.
+        '''
+        sequence = 0
 
-    # test writing a command to get cordinates
-    bus.write_pkt(b'cord', 'c', 0)
+        # Send command and wait for response with filename
+        pkt = self.send_and_wait(cmd.encode(), 'c', sequence)
 
-    # wait for response
-    while True:
-        pkt = bus.wait_response()
-        
+        # Return false on packet error
         if not pkt:
-            continue
+            return False
+
+        # filename, None if the Jetson could not make the file
+        file = self.file_header(pkt, directory)
+        if file is None:
+            return False
+
+        print('Transmission starting')
+
+        chunks = {}
+        reply = (b'', 'r', sequence)
+        self.write_pkt(*reply)
+
+        # Timeout in 3 seconds without hearing from the Jetson
+        timeout = time.time() + 3
+        while True:
+            if timeout < time.time():
+                return False
+
+            data = self.read_msg()
+
+            # Torn or corrupt reads are skipped, the chunk is resent later
+            if not I2CPacket.verify_pkt(data):
+                time.sleep(self.stream_wait)
+                continue
+
+            pkt = I2CPacket.parse_pkt(data)
+
+            # Our own reply is still in the buffer
+            if pkt[I2CPacket.id_index].decode(errors='ignore') != self.pkt_targ_id:
+                time.sleep(self.stream_wait)
+                continue
+
+            timeout = time.time() + 3
+            status = pkt[I2CPacket.stat_index]
+
+            # Store streamed chunk
+            if status == b's':
+                chunks[pkt[I2CPacket.seq_index]] = pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]]
+
+            # End of a window, report the chunks we are missing
+            elif status == b'k':
+                base, count = I2CPacket.window_check.unpack_from(pkt[I2CPacket.data_index])
+                reply = (I2CPacket.missing_bitmap(chunks, base, count), 'n', base)
+                self.write_pkt(*reply)
+
+            # The Jetson could not read our reply, send it again
+            elif status == b'e':
+                self.retries += 1
+                self.write_pkt(*reply)
+
+            # End of transmission, the sequence is the number of chunks
+            elif status == b't':
+                break
+
+            time.sleep(self.stream_wait)
+
+        # Write data to new file
+        with open(file, 'wb') as new_file:
+            for seq in range(pkt[I2CPacket.seq_index]):
+                new_file.write(chunks[seq])
+
+        return True
+
+class I2CTimeout(OSError):
+    '''
+    The Jetson did not answer a request within its retries
+    '''
 
-        if(pkt[I2CPacket.id_index].decode() != bus.pkt_targ_id) or (pkt[I2CPacket.stat_index] != b'd'):
-            continue
 
-        # print received data
-        data = pkt[I2CPacket.data_index].decode().strip('\0')
-        if data:
-            print(data)
-            break;
+class PendingRequest:
+    '''
+    A request waiting for its reply. answered is set by the first packet
+    for the sequence number (ack or reply), reply gets the data
+    '''
+
+    def __init__(self, sequence: int):
+        self.sequence = sequence
+        self.answered = asyncio.Event()
+        self.reply = asyncio.get_running_loop().create_future()
+
+
+class AsyncI2CBus:
+    '''
+    asyncio client for the Jetson on top of I2CBus, so the controller can
+    keep planning while vision works:
+
+        async with AsyncI2CBus() as bus:
+            location = asyncio.ensure_future(bus.cord())
+            ...                     # motion planning
+            print(await location)
+            await bus.image('img w=320')
+
+    Every request gets its own sequence number and several can be in
+    flight; the Jetson acknowledges slow commands with an 'a' packet and
+    answers with a 'd' packet carrying the same sequence number. A single
+    poller task reads the buffer while requests are pending, backing off
+    while nothing changes, and hands each reply to the request with its
+    sequence number. Requests without an answer are resent with growing
+    delays, up to max_attempts times, then fail with I2CTimeout.
+
+    Reads and writes run on one worker thread so the event loop never
+    waits on the I2C bus.
+    '''
+
+    reply_timeout: float = 1.0    # Time for the ack or reply to a request
+    result_timeout: float = 30.0  # Time for the reply once acknowledged
+    max_attempts: int = 4         # Sends of a request before giving up
+    retry_wait: float = 0.1       # Delay before the first resend, doubles after
+
+    spin_time: float = 0.005  # Poll without sleeping this long after a change
+    min_wait: float = 0.002   # First poll delay once spinning is over
+    max_wait: float = 0.05    # Poll delay ceiling while waiting on the Jetson
+
+    def __init__(self, bus: I2CBus = None):
+        self.bus = bus if bus is not None else I2CBus()
+        self.io = ThreadPoolExecutor(max_workers=1)
+        self.backoff = Backoff(self.spin_time, self.min_wait, self.max_wait)
+
+        # Sequence number -> PendingRequest
+        self.pending = {}
+        self.next_sequence = 1
+
+        # Checksum, sequence and sender bytes of the last packet looked at
+        self.last_header = None
+        # Last packet written, sent again when the Jetson asks with 'e'
+        self.last_written = None
+
+        self.link = None
+        self.wake = None
+        self.idle = None
+        self.poller = None
+
+    async def start(self, negotiate: bool = True):
+        # Created here so they belong to the running loop
+        self.link = asyncio.Lock()
+        self.wake = asyncio.Event()
+        # Set while no request is pending
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.poller = asyncio.ensure_future(self.poll_loop())
+        if negotiate:
+            await self.negotiate()
+
+    async def negotiate(self):
+        '''
+        I2CBus.negotiate without blocking, returns the version in use
+        '''
+        try:
+            reply = await self.request(f'version {LATEST_VERSION}')
+        except I2CTimeout:
+            return self.bus.codec.version
+        return self.bus.accept_version(reply)
+
+    async def close(self):
+        self.poller.cancel()
+        try:
+            await self.poller
+        except asyncio.CancelledError:
+            pass
+        for request in self.pending.values():
+            if not request.reply.done():
+                request.reply.set_exception(I2CTimeout('Bus closed'))
+        self.io.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def cord(self):
+        '''
+        Asks the Jetson for the tube location, returns its reply, e.g.
+        'x1.0y2.0z3.0a45.0', 'none', 'error' or 'turn: left'
+        '''
+        return await self.request('cord')
+
+    async def image(self, cmd: str = 'img', windowed: bool = None):
+        '''
+        Receives an image (see I2CBus.read_file for the options in cmd).
+        Waits for the pending requests first, so their replies cannot land
+        in the middle of the transfer. The transfer owns the link until it
+        is done, requests made meanwhile are sent afterwards
+        '''
+        if windowed is None:
+            windowed = cmd.split()[0] == 'imgw' or 'win' in cmd.split()
+        read = self.bus.read_file_windowed if windowed else self.bus.read_file
+        loop = asyncio.get_running_loop()
+        await self.idle.wait()
+        async with self.link:
+            result = await loop.run_in_executor(self.io, read, cmd)
+            self.last_header = None
+        return result
+
+    async def request(self, cmd: str):
+        '''
+        Sends a command and returns the data of the Jetson's reply
+        '''
+        sequence = self.next_sequence
+        # Kept below 2 ** 24, the top byte of a version 1 sequence number
+        # has to stay 0 so it is not mistaken for a version
+        self.next_sequence = self.next_sequence % 0xFFFFFF + 1
+        request = PendingRequest(sequence)
+        self.pending[sequence] = request
+        self.idle.clear()
+        try:
+            for attempt in range(self.max_attempts):
+                if attempt:
+                    await asyncio.sleep(self.retry_wait * 2 ** (attempt - 1))
+                request.answered.clear()
+                if not await self.write(cmd.encode(), 'c', sequence):
+                    continue
+                self.wake.set()
+
+                # First the ack (or the reply itself), then the reply
+                try:
+                    await asyncio.wait_for(request.answered.wait(), self.reply_timeout)
+                    return await asyncio.wait_for(asyncio.shield(request.reply),
+                                                  self.result_timeout)
+                except asyncio.TimeoutError:
+                    continue
+            raise I2CTimeout(f'No reply to {cmd!r} after {self.max_attempts} attempts')
+        finally:
+            del self.pending[sequence]
+            if not self.pending:
+                self.idle.set()
+
+    async def write(self, data: bytes, status: str, sequence: int):
+        pkt = self.bus.codec.create_pkt(data, len(data), status, sequence,
+                                        self.bus.pkt_self_id)
+        loop = asyncio.get_running_loop()
+        async with self.link:
+            # Take in anything the Jetson just wrote before overwriting it
+            await self.poll_once()
+            written = await loop.run_in_executor(self.io, self.bus.write_msg, pkt)
+        self.last_written = pkt
+        self.backoff.reset()
+        return written is not False and written >= 0
+
+    async def poll_once(self):
+        '''
+        Reads the buffer once and dispatches a new packet from the Jetson.
+        Returns True if there was one. Call with the link held
+        '''
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self.io, self.bus.read_msg)
+        if isinstance(data, int) or len(data) < I2CPacket.size:
+            return False
+
+        # An unchanged buffer is not parsed or checksummed again
+        header = data[I2CPacket.header_start:]
+        if header == self.last_header:
+            return False
+        if not I2CPacket.verify_pkt(data):
+            # Torn read, the next poll reads it again
+            return False
+        self.last_header = header
+
+        pkt = I2CPacket.parse_pkt(data)
+        if pkt[I2CPacket.id_index].decode(errors='ignore') != self.bus.pkt_targ_id:
+            return False
+
+        status = pkt[I2CPacket.stat_index]
+        request = self.pending.get(pkt[I2CPacket.seq_index])
+        if status == b'e':
+            # The Jetson could not read our last packet
+            if self.last_written is not None:
+                await loop.run_in_executor(self.io, self.bus.write_msg, self.last_written)
+        elif request is not None and status == b'a':
+            request.answered.set()
+        elif request is not None and status == b'd':
+            request.answered.set()
+            if not request.reply.done():
+                request.reply.set_result(pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]].decode())
+        return True
+
+    async def poll_loop(self):
+        while True:
+            # Nothing to wait for, sleep until the next request
+            if not self.pending:
+                self.wake.clear()
+                await self.wake.wait()
+                self.backoff.reset()
+
+            async with self.link:
+                changed = await self.poll_once()
+            if changed:
+                self.backoff.reset()
+            await asyncio.sleep(self.backoff.delay())
+
+
+# Used for testing sending commands and recieving data with the jetson nano
+async def main():
+    async with AsyncI2CBus() as bus:
+        # test getting the cordinates while the controller keeps working
+        location = asyncio.ensure_future(bus.cord())
+        waited = 0
+        while not location.done():
+            await asyncio.sleep(0.05)
+            waited += 1
+        print(location.result() + f' (after {waited} planning steps)')
 
-    # test recieving an image file
-    data = bus.read_file()
-    print(data)
+        # test recieving an image file
+        print(await bus.image())
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
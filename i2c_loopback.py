@@ -0,0 +1,93 @@
+'''
+Simulated I2C link for testing the protocol off the robot. A SharedBuffer
+stands in for the Jetson's slave-eeprom buffer: Nano_I2CBus takes it as
+its transport and I2CBus as its device, so both sides can talk to each
+other in one process:
+
+    link = SharedBuffer(error_rate=0.05, latency=0.003)
+    jetson = Nano_I2CBus(transport=link)
+    pi = I2CBus(device=link)
+
+or in two processes through a file, SharedBuffer('/tmp/eeprom') on both
+sides. See i2c_benchmark.py for throughput numbers.
+'''
+
+import os
+import time
+import random
+import threading
+
+
+class SharedBuffer:
+    '''
+    256 byte buffer read and written at an offset, like the eeprom buffer.
+    Has both the read(offset, size) / write(offset, data) calls of a
+    pylibi2c.I2CDevice and of the Jetson's eeprom transport.
+
+    Every transfer takes latency seconds and with probability error_rate
+    has bits random bits flipped. A flipped write stays in the buffer, a
+    flipped read only affects that read, like noise on the wire in either
+    direction.
+    '''
+
+    def __init__(self, path: str = None, size: int = 256, error_rate: float = 0.0,
+                 latency: float = 0.0, seed: int = None, bits: int = 1):
+        self.size = size
+        self.error_rate = error_rate
+        self.bits = bits
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Transfers and injected errors so far
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+
+        # In memory, or in a file another process can open too
+        self.fd = None
+        self.data = bytearray(size)
+        if path is not None:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            if os.fstat(self.fd).st_size < size:
+                os.pwrite(self.fd, bytes(size), 0)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self, offset: int, size: int):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.reads += 1
+            if self.fd is not None:
+                data = os.pread(self.fd, size, offset)
+            else:
+                data = bytes(self.data[offset:offset + size])
+            return self.corrupt(data)
+
+    def write(self, offset: int, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.writes += 1
+            data = self.corrupt(bytes(data))
+            if self.fd is not None:
+                return os.pwrite(self.fd, data, offset)
+            self.data[offset:offset + len(data)] = data
+            return len(data)
+
+    def corrupt(self, data: bytes):
+        '''
+        Flips bits random bits of data with probability error_rate.
+        Call with the lock held
+        '''
+        if not data or self.random.random() >= self.error_rate:
+            return data
+        self.errors += 1
+        data = bytearray(data)
+        for bit in self.random.sample(range(len(data) * 8), min(self.bits, len(data) * 8)):
+            data[bit >> 3] ^= 1 << (bit & 7)
+        return bytes(data)
@@ -0,0 +1,239 @@
+'''
+Packet codec and polling helpers shared by the Jetson (Nano_I2C.py) and
+the Raspberry Pi (i2c_bus.py). Copy this file next to i2c_bus.py on the Pi.
+'''
+
+import time
+import zlib
+import struct
+
+class I2CPacket:
+    '''
+    Contains functions that aim to abstract away all the functionality
+    related to packets, mainly building it and verifying packet integrity
+
+    Packet structure (version 1, see I2CPacketV2 for version 2):
+    Size of data                - Python type
+    245 byte for data           - bytes
+    1 byte for data length      - integer
+    1 byte for status messages  - bytes
+    4 bytes for checksum        - integer
+    4 bytes for sequence number - integer
+    1 byte for sender ID        - bytes
+
+    The struct formats are compiled once, packets are packed straight into
+    a caller provided buffer and the checksum is summed over memoryview
+    slices, so no intermediate copies are made.
+
+    Packets are built in the framing of the class they are built with
+    (I2CPacket or I2CPacketV2). verify_pkt and parse_pkt recognize the
+    framing of the packet they are given, so a reader handles both, and
+    parse_pkt returns the same tuple for both.
+    '''
+
+    version: int = 1
+    struct_format: str = '=245sBcIIc'
+    packet: struct.Struct = struct.Struct(struct_format)
+    checksum_field: struct.Struct = struct.Struct('<I')
+    size: int = 256
+    data_len: int = 245
+    data_index: int = 0
+    dlen_index: int = 1
+    stat_index: int = 2
+    par_index: int = 3
+    seq_index: int = 4
+    id_index: int = 5
+
+    # Byte offsets of the checksum field
+    par_start: int = 247
+    par_end: int = 251
+
+    # Version 2 packets have their version number in this byte, in version 1
+    # it is the top byte of the sequence number, which stays 0
+    version_offset: int = 254
+
+    # The checksum, sequence and sender bytes of either framing are all at
+    # or after this offset, so they tell a new packet from the last one
+    header_start: int = 246
+
+    # Windowed file transfer: a 'k' packet carries the first sequence
+    # number and chunk count of a window, the 'n' reply a bitmap of the
+    # chunks of that window the receiver is missing
+    window_check: struct.Struct = struct.Struct('<IH')
+
+    @classmethod
+    def pack_into(cls, buf, data: bytes, size: int, status: str,
+                  sequence: int, ID: str):
+        '''
+        Builds a packet containing the specified data into buf, a writable
+        buffer of at least 256 bytes. Adds in checksum.
+
+        Returns buf, or False if the data does not fit.
+        '''
+        # Check lengths of input. Return false if packing cannot be done
+        if size > cls.data_len:
+            return False
+
+        # Pack with a zero checksum, then fill in the checksum
+        cls.pack_fields(buf, data, size, status[:1].encode(), sequence, ID[:1].encode())
+        cls.checksum_field.pack_into(buf, cls.par_start, cls.checksum(buf))
+        return buf
+
+    @classmethod
+    def pack_fields(cls, buf, data: bytes, size: int, status: bytes,
+                    sequence: int, ID: bytes):
+        cls.packet.pack_into(buf, 0, data, size, status, 0, sequence, ID)
+
+    @classmethod
+    def create_pkt(cls, data: bytes, size: int, status: str,
+                   sequence: int, ID: str):
+        '''
+        Builds a packet containing the specified data. Adds in checksum.
+
+        Returns bytes object for writing.
+        '''
+        pkt = cls.pack_into(bytearray(cls.size), data, size, status, sequence, ID)
+        if not pkt:
+            return False
+        return bytes(pkt)
+
+    @classmethod
+    def checksum(cls, pkt):
+        '''
+        Sum of every packet byte except the checksum field itself
+        '''
+        view = memoryview(pkt)
+        return (sum(view[:cls.par_start]) +
+                sum(view[cls.par_end:cls.size]))
+
+    @staticmethod
+    def framing(pkt):
+        '''
+        Packet class (I2CPacket or I2CPacketV2) of a received packet
+        '''
+        if len(pkt) >= I2CPacket.size and pkt[I2CPacket.version_offset] == I2CPacketV2.version:
+            return I2CPacketV2
+        return I2CPacket
+
+    @classmethod
+    def unpack_fields(cls, pkt):
+        return cls.packet.unpack_from(pkt)
+
+    @staticmethod
+    def parse_pkt(pkt):
+        '''
+        Unpacks packet, returns resulting tuple
+        '''
+        return I2CPacket.framing(pkt).unpack_fields(pkt)
+
+    @staticmethod
+    def verify_pkt(pkt):
+        '''
+        Given a packet, calculates checksum, checks with provided checksum of
+        packet.
+
+        Returns True if they match, False if they do not.
+        '''
+        # Short reads (or error codes from the I2C library) are never valid
+        if isinstance(pkt, int) or len(pkt) < I2CPacket.size:
+            return False
+        framing = I2CPacket.framing(pkt)
+        provided = framing.checksum_field.unpack_from(pkt, framing.par_start)[0]
+        return framing.checksum(pkt) == provided
+
+    @staticmethod
+    def missing_bitmap(received, base: int, count: int):
+        '''
+        Bitmap with bit i set when chunk base + i is not in received
+        '''
+        bitmap = bytearray((count + 7) // 8)
+        for i in range(count):
+            if base + i not in received:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        return bytes(bitmap)
+
+    @staticmethod
+    def missing_seqs(bitmap: bytes, base: int, count: int):
+        '''
+        Sequence numbers flagged as missing in a bitmap from missing_bitmap
+        '''
+        return [base + i for i in range(count)
+                if i >> 3 < len(bitmap) and bitmap[i >> 3] >> (i & 7) & 1]
+
+class I2CPacketV2(I2CPacket):
+    '''
+    Version 2 framing: a CRC-32 (zlib.crc32) instead of the byte sum, which
+    also catches swapped bytes and most multi-bit errors, and a version byte.
+
+    Packet structure:
+    244 byte for data           - bytes
+    1 byte for data length      - integer
+    1 byte for status messages  - bytes
+    4 bytes for CRC-32          - integer
+    4 bytes for sequence number - integer
+    1 byte for version (2)      - integer
+    1 byte for sender ID        - bytes
+
+    Both sides start with version 1. The Pi asks for version 2 with a
+    'version 2' command (see I2CBus.negotiate); the Jetson answers with
+    the newest version it knows and always writes in the framing of the
+    last packet it received from the Pi.
+    '''
+
+    version: int = 2
+    struct_format: str = '=244sBcIIBc'
+    packet: struct.Struct = struct.Struct(struct_format)
+    data_len: int = 244
+
+    par_start: int = 246
+    par_end: int = 250
+
+    @classmethod
+    def pack_fields(cls, buf, data: bytes, size: int, status: bytes,
+                    sequence: int, ID: bytes):
+        cls.packet.pack_into(buf, 0, data, size, status, 0, sequence, cls.version, ID)
+
+    @classmethod
+    def checksum(cls, pkt):
+        '''
+        CRC-32 of every packet byte except the checksum field itself
+        '''
+        view = memoryview(pkt)
+        return zlib.crc32(view[cls.par_end:cls.size], zlib.crc32(view[:cls.par_start]))
+
+    @classmethod
+    def unpack_fields(cls, pkt):
+        # Drop the version so both framings parse to the same tuple
+        fields = cls.packet.unpack_from(pkt)
+        return fields[:5] + fields[6:]
+
+# Framing of every protocol version
+FRAMINGS = {I2CPacket.version: I2CPacket, I2CPacketV2.version: I2CPacketV2}
+LATEST_VERSION = max(FRAMINGS)
+
+class Backoff:
+    '''
+    Adaptive delay between buffer polls. Right after reset() polls happen
+    back to back for spin seconds, then the delay doubles from min_wait up
+    to max_wait, so a quiet link costs almost no CPU while a reply that
+    arrives quickly is still picked up immediately.
+    '''
+
+    def __init__(self, spin: float, min_wait: float, max_wait: float):
+        self.spin = spin
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.reset()
+
+    def reset(self):
+        self.spin_until = time.monotonic() + self.spin
+        self.wait = 0.0
+
+    def delay(self):
+        '''
+        Returns how long to sleep before the next poll
+        '''
+        if time.monotonic() < self.spin_until:
+            return 0.0
+        self.wait = min(max(self.wait * 2, self.min_wait), self.max_wait)
+        return self.wait
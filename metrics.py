@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import logging.handlers
+from stageTimer import StageTimer
+
+
+class Metrics:
+    '''
+    Counters, stage timings (a StageTimer) and a structured event log for
+    the I2C link and the vision loop.
+
+    Log lines go through a queue to a background thread that writes them
+    to a rotating file, so logging never blocks the caller on disk I/O.
+    export() writes every counter and stage percentile to a plain text
+    file, one "name value" line each:
+        i2c_round_trips_total 42
+        stage_seconds{stage="inference",quantile="0.95"} 0.0312
+
+    Usage:
+        metrics.count('i2c_timeouts')
+        with metrics.span('i2c_round_trip'):
+            ...
+        metrics.event('cord', outcome='none', frames=9)
+    '''
+
+    def __init__(self, logFile='logfile', maxBytes=1 << 20, backupCount=5,
+                 metricsFile='metrics.txt', exportInterval=10.0, timer=None):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.timer = timer if timer is not None else StageTimer()
+        self.metricsFile = metricsFile
+        self.exportInterval = exportInterval
+        self.lastExport = time.monotonic()
+
+        # Appends across boots, rolling over to logfile.1 ... logfile.<backupCount>
+        fileHandler = logging.handlers.RotatingFileHandler(logFile, maxBytes=maxBytes,
+                                                           backupCount=backupCount)
+        fileHandler.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+        records = queue.Queue()
+        self.listener = logging.handlers.QueueListener(records, fileHandler)
+        self.listener.start()
+
+        self.logger = logging.getLogger('metrics.' + os.path.basename(logFile))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.handlers = [logging.handlers.QueueHandler(records)]
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def span(self, name):
+        return self.timer.span(name)
+
+    def log(self, msg):
+        self.logger.info(msg)
+
+    def event(self, name, **fields):
+        '''
+        Logs one event as a JSON object, e.g. {"event": "cord", "outcome": "none"}
+        '''
+        fields = dict(event=name, **fields)
+        self.logger.info(json.dumps(fields, default=str))
+
+    def render(self):
+        '''
+        Counters and stage percentiles in the plain text export format
+        '''
+        with self.lock:
+            counters = sorted(self.counters.items())
+        lines = [f'{name}_total {value}' for name, value in counters]
+        for stage in sorted(self.timer.samples):
+            count, *values = self.timer.stats(stage)
+            lines.append(f'stage_count{{stage="{stage}"}} {count}')
+            for percentile, seconds in zip(self.timer.percentiles, values):
+                lines.append(f'stage_seconds{{stage="{stage}",quantile="{percentile / 100}"}} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        '''
+        Writes render() to metricsFile, replacing it in one step so readers
+        never see half a file
+        '''
+        with open(self.metricsFile + '.tmp', 'w') as out:
+            out.write(self.render())
+        os.replace(self.metricsFile + '.tmp', self.metricsFile)
+
+    def exportIfDue(self):
+        '''
+        export() at most once every exportInterval seconds, the stage
+        report also goes to the log every StageTimer.logInterval seconds
+        '''
+        self.timer.logIfDue(self.log)
+        now = time.monotonic()
+        if now - self.lastExport < self.exportInterval:
+            return
+        self.lastExport = now
+        self.export()
+
+    def close(self):
+        '''
+        Flushes the queued log lines and writes a final export
+        '''
+        self.listener.stop()
+        self.export()
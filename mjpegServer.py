@@ -0,0 +1,126 @@
+'''
+Headless viewer: serves annotated frames as an MJPEG stream over HTTP, so
+the detections can be watched from a browser without a desktop session
+on the Jetson.
+    http://<jetson>:<port>/              page with the stream
+    http://<jetson>:<port>/stream        multipart/x-mixed-replace MJPEG
+    http://<jetson>:<port>/snapshot.jpg  the latest frame
+'''
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+from pipeline import LatestSlot
+
+BOUNDARY = 'frame'
+
+PAGE = b'''<html><head><title>VisionSystem</title></head>
+<body style="margin:0;background:#000"><img src="/stream"></body></html>'''
+
+
+class MjpegServer:
+    '''
+    Every published frame is JPEG encoded once, at most fps times a second,
+    and the same bytes are sent to every client. Each client thread waits
+    for the newest frame and skips whatever was published while it was
+    still sending, so a slow client never builds a backlog or slows down
+    the publisher.
+    '''
+
+    def __init__(self, port, fps=10.0, quality=80, host='0.0.0.0'):
+        self.fps = fps
+        self.quality = quality
+        self.frames = LatestSlot()
+        self.nextFrame = 0.0
+
+        self.server = ThreadingHTTPServer((host, port), MjpegHandler)
+        self.server.daemon_threads = True
+        self.server.viewer = self
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print('MJPEG viewer on port ' + str(self.server.server_address[1]))
+
+    def stop(self):
+        self.frames.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def due(self):
+        '''
+        True when the fps limit lets the next frame through, so callers can
+        skip preparing frames that would be dropped
+        '''
+        return time.monotonic() >= self.nextFrame
+
+    def publish(self, image):
+        '''
+        Offers a BGR frame to the clients. Returns False when the frame was
+        dropped by the fps limit
+        '''
+        now = time.monotonic()
+        if now < self.nextFrame:
+            return False
+        # Catch up after a pause instead of sending a burst
+        self.nextFrame = max(self.nextFrame + 1.0 / self.fps, now)
+
+        ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return False
+        self.frames.put(jpeg.tobytes())
+        return True
+
+
+class MjpegHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/':
+            self.sendBody(PAGE, 'text/html')
+        elif self.path == '/snapshot.jpg':
+            _, jpeg = self.server.viewer.frames.get(timeout=5.0)
+            if jpeg is None:
+                self.send_error(503, 'No frame yet')
+            else:
+                self.sendBody(jpeg, 'image/jpeg')
+        elif self.path == '/stream':
+            self.stream()
+        else:
+            self.send_error(404)
+
+    def sendBody(self, body, contentType):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + BOUNDARY)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        frames = self.server.viewer.frames
+        seen = 0
+        try:
+            while not frames.closed:
+                seen, jpeg = frames.get(seen, timeout=5.0)
+                if jpeg is None:
+                    continue
+                self.wfile.write(b'--' + BOUNDARY.encode() + b'\r\n'
+                                 b'Content-Type: image/jpeg\r\n'
+                                 b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n')
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+
+    def log_message(self, format, *args):
+        # Keep the console for the detection output
+        pass
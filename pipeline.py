@@ -0,0 +1,67 @@
+import time
+import threading
+
+
+class LatestSlot:
+    '''
+    Hands the newest item from one producer thread to consumer threads.
+    put never blocks and overwrites an item nobody took yet, so a slow
+    consumer always gets the freshest item instead of a growing backlog.
+    Every item gets a version number; get waits for a version newer than
+    the one the caller saw last, which lets several consumers share a slot.
+    '''
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.item = None
+        self.version = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.changed:
+            self.item = item
+            self.version += 1
+            self.changed.notify_all()
+
+    def get(self, seen=0, timeout=None):
+        '''
+        Returns (version, item) for the first item newer than version seen,
+        or (seen, None) on timeout or once the slot is closed
+        '''
+        with self.changed:
+            if not self.changed.wait_for(lambda: self.version != seen or self.closed, timeout):
+                return seen, None
+            if self.version == seen:
+                return seen, None
+            return self.version, self.item
+
+    def close(self):
+        '''
+        Wakes up every waiting consumer, get returns no item from now on
+        '''
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+
+class FpsCounter:
+    '''
+    Rate of tick() calls, measured since the last call to rate()
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.start = time.monotonic()
+
+    def tick(self):
+        with self.lock:
+            self.count += 1
+
+    def rate(self):
+        with self.lock:
+            now = time.monotonic()
+            rate = self.count / max(now - self.start, 1e-9)
+            self.count = 0
+            self.start = now
+        return rate
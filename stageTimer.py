@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import deque
+
+
+class Span:
+    '''
+    Context manager timing one stage, created by StageTimer.span
+    '''
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    '''
+    Low overhead per-stage latency tracking. Every stage keeps a rolling
+    window of its latest durations, percentiles are only computed when a
+    report is requested, so recording is just a clock read and an append.
+
+    Usage:
+        with timer.span('inference'):
+            results = model(image)
+    '''
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, window=500, logInterval=60.0):
+        self.window = window
+        self.logInterval = logInterval
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.lastLog = time.monotonic()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def record(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            with self.lock:
+                samples = self.samples.setdefault(name, deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def stats(self, name):
+        '''
+        Returns (count, p50, p95, p99) in seconds for a stage
+        '''
+        ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return 0, 0.0, 0.0, 0.0
+        last = len(ordered) - 1
+        return (len(ordered),) + tuple(ordered[round(p / 100 * last)]
+                                       for p in self.percentiles)
+
+    def report(self):
+        '''
+        One line per stage with its rolling percentiles in milliseconds
+        '''
+        lines = []
+        for name in list(self.samples):
+            count, p50, p95, p99 = self.stats(name)
+            lines.append(f'{name}: n={count} p50={p50 * 1000:.1f}ms '
+                         f'p95={p95 * 1000:.1f}ms p99={p99 * 1000:.1f}ms')
+        return '\n'.join(lines)
+
+    def logIfDue(self, write):
+        '''
+        Passes the report to write (e.g. Nano_I2CBus.write_log) once every
+        logInterval seconds
+        '''
+        now = time.monotonic()
+        if now - self.lastLog < self.logInterval or not self.samples:
+            return
+        self.lastLog = now
+        for line in self.report().split('\n'):
+            write(line)
@@ -1,122 +1,238 @@
-import pyrealsense2 as rs
+import argparse
+import threading
+import time
 import numpy as np
 import cv2
-import time
-import torch
 import math
 import edge
-
-#MAIN
+from frameSource import openSource
+from geometry import CameraGeometry
+from detector import loadDetector
+from tracker import BoxTracker
+from pipeline import LatestSlot, FpsCounter
+from mjpegServer import MjpegServer
 
 HEIGHT_OF_CAMERA = 45.0
 
-# Build Neural Net
-model = torch.hub.load('/home/herbie/OVision2022/pyrealsense/librealsense-2.51.1/build/', 'custom', path='best.pt', source='local')
+# Seconds between the per stage FPS reports
+REPORT_INTERVAL = 2.0
+
+
+def detect(model, tracker, color_image):
+    '''
+    Returns the tube row (x1, y1, x2, y2, conf, class) or None, and the
+    detector results when the detector ran (None for tracked frames)
+    '''
+    if tracker is not None and not tracker.needsDetection():
+        return tracker.predict(color_image), None
+
+    results = model(color_image)
+    tube = results.xyxy[0][0] if len(results.xyxy) > 0 and len(results.xyxy[0]) > 0 else None
+    if tracker is not None:
+        tracker.update(tube, color_image)
+    return tube, results
+
+
+def measure(tube, depth_frame, color_image, geometry):
+    '''
+    Text lines for the tube position and orientation, None without depth.
+    Has to run before anything is drawn into color_image
+    '''
+    centery = int((tube[1] + tube[3])/2)
+    centerx = int((tube[0] + tube[2])/2)
+    depth = depth_frame.get_distance(centerx, centery) * 100
+    if depth <= 0:
+        return None
 
-# Set up pipeline
-pipeline = rs.pipeline()
-config = rs.config()
+    real_x = geometry.deproject(centerx, centery, depth)[0]
+    groundhyp = (depth ** 2 - HEIGHT_OF_CAMERA ** 2) ** .5
+    real_y = (groundhyp ** 2 - real_x ** 2) ** .5
+    #real_y = (centery - 240) * depth_frame.get_distance(centerx, centery) /386
+    #real_z = math.sqrt(pow(real_x, 2) + pow(real_y, 2))
+    #real_depth_angle = math.asin(real_z / depth_frame.get_distance(centerx, centery))
+    #real_xy_angle = math.atan(-real_y/real_x)
 
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+    xdist = (tube[0] - tube[2])
+    ydist = (tube[1] - tube[3])
+    ratio = xdist / ydist
+    if (ratio > 3):
+        orient = "Orientation: 90.00"
+    elif (ratio < .55):
+        orient = "Orientation: 0.00"
+    else:
+        print("EDGE!! \n")
+        print(tube)
+        orient = "Orientation: " + str(round(edge.get_degrees((int(tube[0]), int(tube[1])), (int(tube[2]), int(tube[3])), (centerx, centery), color_image), 2))
 
-# Start streaming
-pipeline.start(config)
+    print("Ratio: " + str(ratio) + "\n")
+    lines = [(410, "X-Coord: " + str(round(real_x, 2)))]
+    if (not isinstance(real_y, complex)):
+        lines.append((430, "Y-Coord: " + str(round(real_y, 2))))
+    lines.append((450, "   Depth: " + str(round(depth, 2))))
+    lines.append((470, orient))
+    #print("\nreal coords:", real_x, real_y, depth, "\n\n")
+    return (centerx, centery), lines
 
-try:
-    while True:
+
+def annotate(color_image, tube, results, measurement):
+    '''
+    Draws the detections (or the tracked box) and the measurement text,
+    returns the image to show
+    '''
+    if results is not None:
+        results.render()
+        display = results.ims[0]
+    else:
+        display = color_image
+        if tube is not None:
+            cv2.rectangle(display, (int(tube[0]), int(tube[1])), (int(tube[2]), int(tube[3])),
+                          (0, 255, 0), 2)
+
+    if measurement is None:
+        return display
+    center, lines = measurement
+    for y, text in lines:
+        cv2.putText(display,
+                text,
+                (10, y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                .5,
+                (0, 0, 255),
+                1)
+    cv2.circle(display, center, 5, (0,0,255), 2)
+    return display
+
+
+def captureStage(source, frameSlot, fps, stop):
+    while not stop.is_set():
+        try:
+            frames = source.wait_for_frames()
+        except RuntimeError:
+            # wait_for_frames timed out, try again
+            continue
+        # Keep the frameset alive outside of librealsense's frame pool
+        frames.keep()
+        frameSlot.put(frames)
+        fps.tick()
+
+
+def inferenceStage(model, tracker, geometry, frameSlot, resultSlot, fps, stop):
+    seen = 0
+    while not stop.is_set():
+        # Always the newest frameset, the ones captured meanwhile are dropped
+        seen, frames = frameSlot.get(seen, timeout=0.5)
+        if frames is None:
+            continue
 
         # Wait for a coherent pair of frames: depth and color
-        frames = pipeline.wait_for_frames()
         depth_frame = frames.get_depth_frame()
         color_frame = frames.get_color_frame()
         if not depth_frame or not color_frame:
             continue
 
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
+        # The detections are drawn straight into the frame, which is not
+        # used for anything else once it is measured
         color_image = np.asanyarray(color_frame.get_data())
+        tube, results = detect(model, tracker, color_image)
+        measurement = measure(tube, depth_frame, color_image, geometry) if tube is not None else None
+        display = annotate(color_image, tube, results, measurement)
 
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
+        resultSlot.put((display, depth_frame))
+        fps.tick()
 
-        image = color_image.copy()
-        results = model(image)
-        results.render()
-        print(image.shape)
-        print(color_image.shape)
-        if len(results.xyxy) > 0 and len(results.xyxy[0]) > 0:
-            centery = int((results.xyxy[0][0][1] + results.xyxy[0][0][3])/2)
-            centerx = int((results.xyxy[0][0][0] + results.xyxy[0][0][2])/2)
-            depth = depth_frame.get_distance(centerx, centery) * 100
-            
-            if (depth > 0): 
-                real_x = (centerx - 320) * depth / 386
-                groundhyp = (depth ** 2 - HEIGHT_OF_CAMERA ** 2) ** .5
-                real_y = (groundhyp ** 2 - real_x ** 2) ** .5
-                #real_y = (centery - 240) * depth_frame.get_distance(centerx, centery) /386
-                #real_z = math.sqrt(pow(real_x, 2) + pow(real_y, 2))
-                #real_depth_angle = math.asin(real_z / depth_frame.get_distance(centerx, centery))
-                #real_xy_angle = math.atan(-real_y/real_x)
-
-                xdist = (results.xyxy[0][0][0] - results.xyxy[0][0][2])
-                ydist = (results.xyxy[0][0][1] - results.xyxy[0][0][3])
-                ratio = xdist / ydist
-                if (ratio > 3):
-                    orient = "Orientation: 90.00"
-                elif (ratio < .55):
-                    orient = "Orientation: 0.00"
+
+def main():
+    parser = argparse.ArgumentParser(description='Visualize the tube detection')
+    parser.add_argument('--replay', help='recorded session (.npz, .bag or directory) to use instead of the camera')
+    parser.add_argument('--fps', type=float, help='replay rate, as fast as possible when omitted')
+    parser.add_argument('--backend', default='torch', choices=('torch', 'onnx', 'opencv'),
+                        help='detector backend, see detector.py')
+    parser.add_argument('--quantize', action='store_true', help='use the int8 ONNX model')
+    parser.add_argument('--track', type=int, metavar='N',
+                        help='run the detector every N frames and track the box in between')
+    parser.add_argument('--flow', action='store_true', help='refine the tracked box with optical flow')
+    parser.add_argument('--depth', action='store_true', help='show the depth colormap next to the detections')
+    parser.add_argument('--http', type=int, metavar='PORT',
+                        help='no window, serve the frames as an MJPEG stream on this port instead')
+    parser.add_argument('--http-fps', type=float, default=10.0, help='frame rate limit of the MJPEG stream')
+    parser.add_argument('--http-quality', type=int, default=80, help='JPEG quality of the MJPEG stream')
+    args = parser.parse_args()
+
+    # Build Neural Net
+    model = loadDetector(args.backend, '/home/herbie/OVision2022/pyrealsense/librealsense-2.51.1/build/', 'best.pt', args.quantize)
+
+    # Predicts the box between detector runs
+    tracker = BoxTracker(detectEvery=args.track, flow=args.flow) if args.track else None
+
+    # Set up the camera or recorded session
+    source = openSource(args.replay, args.fps)
+
+    # Start streaming
+    source.start()
+    geometry = CameraGeometry.fromIntrinsics(source.get_intrinsics())
+
+    # capture -> frameSlot -> inference -> resultSlot -> display (this thread,
+    # cv2 windows have to live on the main thread). Each slot only holds the
+    # newest item, so a slow stage drops frames instead of lagging behind
+    frameSlot, resultSlot = LatestSlot(), LatestSlot()
+    rates = {'capture': FpsCounter(), 'inference': FpsCounter(), 'display': FpsCounter()}
+    stop = threading.Event()
+    stages = [
+        threading.Thread(target=captureStage, args=(source, frameSlot, rates['capture'], stop), daemon=True),
+        threading.Thread(target=inferenceStage, args=(model, tracker, geometry, frameSlot, resultSlot,
+                                                      rates['inference'], stop), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # Headless: the display stage feeds the MJPEG viewer instead of a window
+    viewer = None
+    if args.http:
+        viewer = MjpegServer(args.http, args.http_fps, args.http_quality)
+        viewer.start()
+
+    try:
+        seen = 0
+        nextReport = time.monotonic() + REPORT_INTERVAL
+        if viewer is None:
+            cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
+        while True:
+            seen, result = resultSlot.get(seen, timeout=0.03)
+            if result is not None and (viewer is None or viewer.due()):
+                display, depth_frame = result
+                if args.depth:
+                    # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
+                    depth_image = np.asanyarray(depth_frame.get_data())
+                    depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
+                    display = np.hstack((display, depth_colormap))
+                # Show images
+                if viewer is None:
+                    cv2.imshow('RealSense', display)
                 else:
-                    print("EDGE!! \n")
-                    print(results.xyxy[0][0])
-                    orient = "Orientation: " + str(round(edge.get_degrees((int(results.xyxy[0][0][0]), int(results.xyxy[0][0][1])), (int(results.xyxy[0][0][2]), int(results.xyxy[0][0][3])), (centerx, centery), color_image), 2))
-                    
-                print("Ratio: " + str(ratio) + "\n")
-                cv2.putText(results.ims[0],
-                        "X-Coord: " + str(round(real_x, 2)),
-                        (10, 410),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)
-                if (not isinstance(real_y, complex)): 
-                    cv2.putText(results.ims[0],
-                        "Y-Coord: " + str(round(real_y, 2)),
-                        (10, 430),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                cv2.putText(results.ims[0],
-                        "   Depth: " + str(round(depth, 2)),
-                        (10, 450),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                cv2.putText(results.ims[0],
-                        orient,
-                        (10, 470),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                #print("\nreal coords:", real_x, real_y, depth, "\n\n")
-                cv2.circle(results.ims[0], (centerx, centery), 5, (0,0,255), 2)
-                
-                #print("x coordinate: " + str((centerx - 320) * depth_frame.get_distance(centerx, centery) /386))
-                #print("y coordinate: " + str((centery - 240) * depth_frame.get_distance(centerx, centery) /386))
-                #print("Tube is " + str(depth_frame.get_distance(centerx, centery)) + " m away")
-                #print("Rotate " + str(real_xy_angle * 180 / math.pi) + " degrees in the xy plane and " + str(real_depth_angle * 180 / math.pi) + "degrees in the z plane")
-            
-        
-        images = np.hstack((image, depth_colormap))
-        # Show images
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', results.ims[0])
-
-        cv2.waitKey(1)
-finally:
-
-    # Stop streaming
-    pipeline.stop()
+                    viewer.publish(display)
+                rates['display'].tick()
+
+            if viewer is None and cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+            if time.monotonic() >= nextReport:
+                nextReport += REPORT_INTERVAL
+                print('  '.join(f'{name} {rate.rate():.1f} fps' for name, rate in rates.items()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if viewer is not None:
+            viewer.stop()
+        stop.set()
+        frameSlot.close()
+        resultSlot.close()
+        for stage in stages:
+            stage.join()
+
+        # Stop streaming
+        source.stop()
+        source.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import numpy as np
+import cv2
+
+
+class BoxTracker:
+    '''
+    Follows one tube box between detector runs with a constant velocity
+    Kalman filter over the box center and size (cx, cy, w, h and their
+    per frame velocities). With flow the box is also moved by the median
+    Lucas-Kanade optical flow of corners inside it.
+
+    Usage, once per frame:
+        if tracker.needsDetection():
+            tube = tracker.update(detect(image), image)
+        else:
+            tube = tracker.predict(image)
+    Both return a detection row (x1, y1, x2, y2, conf, class) or None.
+
+    The confidence of the track starts at the detection confidence and is
+    multiplied by decay every predicted frame (by decay squared when the
+    flow is lost), so the detector runs again every detectEvery frames or
+    sooner once the confidence drops below minConfidence.
+    '''
+
+    def __init__(self, detectEvery=5, minConfidence=0.3, decay=0.9, flow=False,
+                 processNoise=1e-2, measurementNoise=1e-1, minFlowPoints=5):
+        self.detectEvery = detectEvery
+        self.minConfidence = minConfidence
+        self.decay = decay
+        self.flow = flow
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.minFlowPoints = minFlowPoints
+        self.reset()
+
+    def reset(self):
+        '''
+        Drops the track, the next frame runs the detector
+        '''
+        self.kalman = None
+        self.box = None
+        self.confidence = 0.0
+        self.cls = 0.0
+        self.sinceDetection = 0
+        self.previousGray = None
+
+    def needsDetection(self):
+        return (self.kalman is None or
+                # sinceDetection counts the predicted frames, the detection
+                # frame itself is one of the detectEvery
+                self.sinceDetection >= self.detectEvery - 1 or
+                self.confidence < self.minConfidence)
+
+    def update(self, detection, image=None):
+        '''
+        Corrects the track with a detector result. None (nothing found)
+        drops the track. Returns the detection
+        '''
+        if detection is None:
+            self.reset()
+            return None
+
+        x1, y1, x2, y2, conf, cls = (float(v) for v in detection[:6])
+        measurement = np.array([[(x1 + x2) / 2], [(y1 + y2) / 2],
+                                [x2 - x1], [y2 - y1]], np.float32)
+        if self.kalman is None:
+            self.kalman = self.createFilter(measurement)
+        else:
+            self.kalman.predict()
+            self.kalman.correct(measurement)
+
+        self.box = (x1, y1, x2, y2)
+        self.confidence = conf
+        self.cls = cls
+        self.sinceDetection = 0
+        if self.flow and image is not None:
+            self.previousGray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return detection
+
+    def predict(self, image=None):
+        '''
+        Box of the tube in the next frame without running the detector.
+        Returns None if there is no track
+        '''
+        if self.kalman is None:
+            return None
+
+        state = self.kalman.predict()
+        self.sinceDetection += 1
+        self.confidence *= self.decay
+
+        if self.flow and image is not None:
+            shift = self.flowShift(image)
+            if shift is None:
+                self.confidence *= self.decay
+            else:
+                # The flow is a measurement of where the last box moved to
+                x1, y1, x2, y2 = self.box
+                measurement = np.array([[(x1 + x2) / 2 + shift[0]], [(y1 + y2) / 2 + shift[1]],
+                                        [x2 - x1], [y2 - y1]], np.float32)
+                state = self.kalman.correct(measurement)
+
+        cx, cy, w, h = state[:4, 0]
+        w, h = max(w, 1.0), max(h, 1.0)
+        x1, y1, x2, y2 = cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2
+        if image is not None:
+            height, width = image.shape[:2]
+            x1, x2 = np.clip((x1, x2), 0, width - 1)
+            y1, y2 = np.clip((y1, y2), 0, height - 1)
+        self.box = (float(x1), float(y1), float(x2), float(y2))
+        return np.array(self.box + (self.confidence, self.cls), np.float32)
+
+    def createFilter(self, measurement):
+        kalman = cv2.KalmanFilter(8, 4)
+
+        # Position and size move by their velocity every frame
+        transition = np.eye(8, dtype=np.float32)
+        transition[:4, 4:] = np.eye(4, dtype=np.float32)
+        kalman.transitionMatrix = transition
+        kalman.measurementMatrix = np.eye(4, 8, dtype=np.float32)
+        kalman.processNoiseCov = np.eye(8, dtype=np.float32) * self.processNoise
+        kalman.measurementNoiseCov = np.eye(4, dtype=np.float32) * self.measurementNoise
+
+        # Start at the detection, the velocities are unknown
+        kalman.statePost = np.vstack((measurement, np.zeros((4, 1), np.float32)))
+        kalman.errorCovPost = np.diag([1, 1, 1, 1, 100, 100, 100, 100]).astype(np.float32)
+        return kalman
+
+    def flowShift(self, image):
+        '''
+        Median optical flow (dx, dy) of corners inside the last box between
+        the previous and this frame, None if too few could be followed
+        '''
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        previous, self.previousGray = self.previousGray, gray
+        if previous is None:
+            return None
+
+        height, width = gray.shape
+        x1, y1, x2, y2 = (int(v) for v in self.box)
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, width), min(y2, height)
+        if x2 - x1 < 4 or y2 - y1 < 4:
+            return None
+
+        corners = cv2.goodFeaturesToTrack(previous[y1:y2, x1:x2], maxCorners=30,
+                                          qualityLevel=0.01, minDistance=3)
+        if corners is None or len(corners) < self.minFlowPoints:
+            return None
+        corners = corners + np.array([x1, y1], np.float32)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(previous, gray, corners, None)
+        good = status.ravel() == 1
+        if good.sum() < self.minFlowPoints:
+            return None
+        return np.median((moved - corners)[good].reshape(-1, 2), axis=0)
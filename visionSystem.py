@@ -4,27 +4,164 @@ sys.path.append(".")
 sys.path.append("/usr/local/lib")
 sys.path.append("/usr/local/lib/python3.8/pyrealsense2")
 
-import pyrealsense2 as rs
 import numpy as np
 import cv2
 import time
-import torch
 import math
+import threading
+from collections import deque
 import edge
+from frameSource import RealSenseSource
+from stageTimer import StageTimer
+from geometry import CameraGeometry
+from detector import loadDetector
 
 
 class VisionSystem:
     def __init__(self, directoryOfNNWeights='/home/herbie/OVision2022/yolov5',
-                 nameOfWeights="/home/herbie/OVision2022/yolov5/last.pt"):
-        self.model = torch.hub.load(directoryOfNNWeights, 'custom',
-                                    path=nameOfWeights,
-                                    source='local')
-        self.pipeline = rs.pipeline()
-        self.config = rs.config()
-        
-       
-        self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        self.config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+                 nameOfWeights="/home/herbie/OVision2022/yolov5/last.pt",
+                 continuous=False, bufferSize=3, warmupFrames=5,
+                 frameSource=None, headless=False, classes=None,
+                 depthWindow=5, depthFromBox=False, minDepthFraction=0.1,
+                 warmupBatches=(1, 3), backend='torch', quantize=False,
+                 inferenceSize=640, roiPadding=None, roiSize=320,
+                 tracker=None, timer=None):
+        # 'torch' (YOLOv5 hub model), 'onnx' or 'opencv', see detector.py
+        self.model = loadDetector(backend, directoryOfNNWeights, nameOfWeights, quantize)
+
+        # Only keep these class ids, filtered inside the model's NMS
+        self.model.classes = classes
+
+        # Headless mode skips drawing the boxes into the frames
+        self.headless = headless
+
+        # Depth is the median of the valid pixels in a (2 * depthWindow + 1)
+        # square around the box center, or of the whole box with depthFromBox.
+        # Below minDepthFraction valid pixels the depth is reported as 0
+        self.depthWindow = depthWindow
+        self.depthFromBox = depthFromBox
+        self.minDepthFraction = minDepthFraction
+
+        # Pixel box (x1, y1, x2, y2) of the last detected tube
+        self.lastBox = None
+
+        # Longest image side the network sees (the model resizes to it)
+        self.inferenceSize = inferenceSize
+
+        # ROI re-detection: with roiPadding set, once a tube was found the
+        # next frames only go through the network as a crop around its box,
+        # padded by roiPadding box sizes on every side and run at roiSize.
+        # A frame the crop misses is run again at full frame.
+        self.roiPadding = roiPadding
+        self.roiSize = roiSize
+        self.roiBox = None
+
+        # Optional tracker.BoxTracker: between detector runs the tube box
+        # is predicted from the previous frames instead
+        self.tracker = tracker
+
+        # Live camera by default, a ReplaySource for offline runs
+        self.source = frameSource if frameSource is not None else RealSenseSource()
+
+        # Pixel to camera coordinates, built from the stream intrinsics the
+        # first time the source is started
+        self.geometry = None
+
+        # Rolling per-stage latencies, see StageTimer.report. Pass the
+        # timer of a metrics.Metrics to export them with the I2C metrics
+        self.timer = timer if timer is not None else StageTimer()
+
+        # Framesets handed out by captureImages so far
+        self.framesCaptured = 0
+
+        # Run the first (slow) inferences now instead of on the first cord
+        self.warmup(warmupBatches)
+
+        # Long-lived capture mode: the frame source is started once and a
+        # background thread keeps a small ring buffer of the latest framesets
+        self.frameBuffer = deque(maxlen=bufferSize)
+        self.frameReady = threading.Condition()
+        self.warmupFrames = warmupFrames
+        self.captureThread = None
+        self.running = False
+        if continuous:
+            self.startCapture()
+
+    def warmup(self, batchSizes, height=480, width=640):
+        '''
+        Runs blank frames through the model once per batch size so CUDA
+        initialization and kernel selection happen before we report Ready
+        '''
+        blank = np.zeros((height, width, 3), np.uint8)
+        sizes = [self.inferenceSize]
+        if self.roiPadding is not None:
+            sizes.append(self.roiSize)
+        for size in sizes:
+            for batchSize in batchSizes:
+                self.model([blank] * batchSize, size=size)
+
+    def startCapture(self):
+        '''
+        Starts the frame source once and spawns the background capture thread.
+        Afterwards captureImage hands out the freshest frameset instead of
+        starting and stopping the camera for every frame.
+        '''
+        if self.running:
+            return
+        self.startSource()
+        self.running = True
+        self.captureThread = threading.Thread(target=self.captureLoop,
+                                              daemon=True)
+        self.captureThread.start()
+
+    def startSource(self):
+        self.source.start()
+        if self.geometry is None:
+            self.geometry = CameraGeometry.fromIntrinsics(self.source.get_intrinsics())
+
+    def stopCapture(self):
+        '''
+        Stops the background capture thread and the frame source.
+        '''
+        if not self.running:
+            return
+        self.running = False
+        self.captureThread.join()
+        self.captureThread = None
+        self.source.stop()
+        with self.frameReady:
+            self.frameBuffer.clear()
+
+    def captureLoop(self):
+        # Throw away the first frames while auto exposure settles
+        skip = self.warmupFrames
+        while self.running:
+            try:
+                frames = self.source.wait_for_frames()
+            except RuntimeError:
+                # wait_for_frames timed out, try again
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+
+            # Keep the frameset alive outside of librealsense's frame pool
+            frames.keep()
+            with self.frameReady:
+                self.frameBuffer.append(frames)
+                self.frameReady.notify_all()
+
+    def latestFrames(self, timeout=1.0):
+        '''
+        Waits for and returns the freshest frameset from the ring buffer.
+        Older framesets are dropped so the next call gets a new frame.
+        '''
+        with self.frameReady:
+            if not self.frameReady.wait_for(lambda: self.frameBuffer, timeout):
+                raise RuntimeError('No frame received from the capture thread')
+            frames = self.frameBuffer.pop()
+            self.frameBuffer.clear()
+        return frames
 
     def processOneFrame(self):
         '''
@@ -34,39 +171,164 @@ class VisionSystem:
             int, int, 0, int -> found a tube but couldnt get depth info
             -1, -1, -1, -1 -> no tube found
         '''
-        color_frame, depth_frame = self.captureImage()
-        results = self.checkForTube(color_frame)
-        return self.getTubeData(color_frame, depth_frame, results)
+        return self.processFrames(1)[0]
+
+    def processFrames(self, count):
+        '''
+        Batched version of processOneFrame. Grabs count framesets, runs them
+        through the model in a single forward pass and returns a list with
+        the x, y, depth, orientation of every frame (same outputs as
+        processOneFrame)
+        '''
+        with self.timer.span('capture'):
+            frames = self.captureImages(count)
+        colorFrames = [color_frame for color_frame, _ in frames]
+        tubeResults = self.trackTubes(colorFrames)
+        return [self.getTubeData(color_frame, depth_frame, results)
+                for (color_frame, depth_frame), results in zip(frames, tubeResults)]
 
     def captureImage(self):
-        self.pipeline.start(self.config)
-        frames = self.pipeline.wait_for_frames()
-        depth_frame = frames.get_depth_frame()
-        color_frame = frames.get_color_frame()
-        self.pipeline.stop()
-        return color_frame, depth_frame 
+        return self.captureImages(1)[0]
+
+    def captureImages(self, count):
+        '''
+        Returns a list of count (color_frame, depth_frame) pairs, each from a
+        different frameset
+        '''
+        self.framesCaptured += count
+        if self.running:
+            framesets = [self.latestFrames() for _ in range(count)]
+        else:
+            self.startSource()
+            framesets = []
+            for _ in range(count):
+                frames = self.source.wait_for_frames()
+                frames.keep()
+                framesets.append(frames)
+            self.source.stop()
+        return [(frames.get_color_frame(), frames.get_depth_frame())
+                for frames in framesets]
 
     def checkForTube(self, color_frame):
-        color_image = np.asanyarray(color_frame.get_data())
-        results = self.model(color_image)
-        results.render()
-        highestConf = -1
-        bestResults = None
-        #print(results.xyxy)
-        if not results.xyxy:
+        return self.checkForTubes([color_frame])[0]
+
+    def checkForTubes(self, colorFrames):
+        '''
+        Runs every color frame through the model as one batch and returns
+        the chosen detection of each frame (None where nothing was found)
+        '''
+        color_images = [np.asanyarray(color_frame.get_data())
+                        for color_frame in colorFrames]
+
+        roi = self.roiBounds(color_images[0].shape) if self.roiPadding is not None else None
+        if roi is not None:
+            tubeResults = self.detectInRoi(color_images, roi)
+            missed = [i for i, tube in enumerate(tubeResults) if tube is None]
+        else:
+            tubeResults = [None] * len(color_images)
+            missed = list(range(len(color_images)))
+
+        if missed:
+            with self.timer.span('inference'):
+                results = self.model([color_images[i] for i in missed],
+                                     size=self.inferenceSize)
+            if not self.headless:
+                with self.timer.span('render'):
+                    results.render()
+            #print(results.xyxy)
+            for i, detections in zip(missed, results.xyxy):
+                tubeResults[i] = self.bestDetection(detections)
+
+        # Crop around the newest tube next time, full frame if it is gone
+        found = [tube for tube in tubeResults if tube is not None]
+        self.roiBox = tuple(float(v) for v in found[-1][:4]) if found else None
+        return tubeResults
+
+    def trackTubes(self, colorFrames):
+        '''
+        checkForTubes with the tracker in between: frames the tracker can
+        predict skip the detector, the others are detected one by one and
+        correct the track. Without a tracker this is checkForTubes
+        '''
+        if self.tracker is None:
+            return self.checkForTubes(colorFrames)
+
+        tubeResults = []
+        for color_frame in colorFrames:
+            color_image = np.asanyarray(color_frame.get_data())
+            if self.tracker.needsDetection():
+                tube = self.checkForTubes([color_frame])[0]
+                self.tracker.update(tube, color_image)
+            else:
+                with self.timer.span('track'):
+                    tube = self.tracker.predict(color_image)
+            tubeResults.append(tube)
+        return tubeResults
+
+    def roiBounds(self, shape):
+        '''
+        Pixel crop (x1, y1, x2, y2) around the last detected box, padded by
+        roiPadding box sizes (at least 32 pixels) and clipped to the image.
+        None when there is no box to crop around
+        '''
+        if self.roiBox is None:
             return None
+        height, width = shape[:2]
+        x1, y1, x2, y2 = self.roiBox
+        padX = max((x2 - x1) * self.roiPadding, 32)
+        padY = max((y2 - y1) * self.roiPadding, 32)
+        return (max(int(x1 - padX), 0), max(int(y1 - padY), 0),
+                min(int(x2 + padX), width), min(int(y2 + padY), height))
 
-        for i in results.xyxy[0]:
-            if i[5] > highestConf:
-                bestResults = i
+    def detectInRoi(self, color_images, roi):
+        '''
+        Runs only the roi crop of every image through the model and returns
+        the chosen detection of each one in full image pixels
+        '''
+        x1, y1, x2, y2 = roi
+        with self.timer.span('roi'):
+            results = self.model([image[y1:y2, x1:x2] for image in color_images],
+                                 size=self.roiSize)
+        if not self.headless:
+            with self.timer.span('render'):
+                results.render()
 
-        return bestResults
+        tubeResults = []
+        for detections in results.xyxy:
+            tube = self.bestDetection(detections)
+            if tube is not None:
+                # Copy before shifting, the row is a view into the results
+                tube = tube.clone() if hasattr(tube, 'clone') else tube.copy()
+                tube[[0, 2]] += x1
+                tube[[1, 3]] += y1
+            tubeResults.append(tube)
+        return tubeResults
+
+    def bestDetection(self, detections):
+        '''
+        Returns the most confident row (x1, y1, x2, y2, conf, class) of a
+        detection tensor, None if it is empty
+        '''
+        if len(detections) == 0:
+            return None
+        return detections[detections[:, 4].argmax()]
+
+    def topDetections(self, detections, k):
+        '''
+        Returns up to k rows of a detection tensor (or array), most
+        confident first
+        '''
+        order = detections[:, 4].argsort()
+        order = order.flip(0) if hasattr(order, 'flip') else order[::-1]
+        return detections[order[:k]]
 
     def getTubeData(self, color_frame, depth_frame, tubeResults):
         if tubeResults is not None:
+            self.lastBox = tuple(int(v) for v in tubeResults[:4])
             centerx, centery = self.getTubePixelCoordinates(tubeResults)
-            realx, realy, depth = self.translatePixelsToReal(centerx, centery, depth_frame)
-            orientation = self.getTubeOrientation(color_frame, tubeResults, centerx, centery)
+            realx, realy, depth = self.translatePixelsToReal(centerx, centery, depth_frame, tubeResults)
+            with self.timer.span('orientation'):
+                orientation = self.getTubeOrientation(color_frame, tubeResults, centerx, centery)
             return realx, realy, depth, orientation
         return -1, -1, -1, -1
 
@@ -75,12 +337,40 @@ class VisionSystem:
         centery = int((tubeResults[1] + tubeResults[3]) / 2)
         return centerx, centery
 
-    def translatePixelsToReal(self, centerx, centery, depth_frame):
-        depth = depth_frame.get_distance(centerx, centery) * 100
-        realx = (centerx - 320) * depth / 386
-        realy = (centery - 240) * depth / 386
+    def translatePixelsToReal(self, centerx, centery, depth_frame, tubeResults=None):
+        with self.timer.span('depth'):
+            depth, _ = self.estimateDepth(depth_frame, centerx, centery, tubeResults)
+        with self.timer.span('translate'):
+            realx, realy, depth = self.geometry.deproject(centerx, centery, depth).tolist()
         return realx, realy, depth
 
+    def estimateDepth(self, depth_frame, centerx, centery, tubeResults=None):
+        '''
+        Robust depth in cm around a pixel, so a single depth hole does not
+        throw the whole frame away.
+        Returns depth, confidence where confidence is the fraction of valid
+        pixels in the sampled region. depth is 0 if too few are valid
+        '''
+        depth_image = np.asanyarray(depth_frame.get_data())
+        if self.depthFromBox and tubeResults is not None:
+            x0, y0, x1, y1 = (int(v) for v in tubeResults[:4])
+        else:
+            x0, y0 = centerx - self.depthWindow, centery - self.depthWindow
+            x1, y1 = centerx + self.depthWindow + 1, centery + self.depthWindow + 1
+
+        height, width = depth_image.shape
+        region = depth_image[max(y0, 0):min(y1, height), max(x0, 0):min(x1, width)]
+        if region.size == 0:
+            return 0, 0.0
+
+        # Zero means no depth data for that pixel
+        valid = region[region > 0]
+        confidence = valid.size / region.size
+        if confidence < self.minDepthFraction:
+            return 0, confidence
+
+        return float(np.median(valid)) * depth_frame.get_units() * 100, confidence
+
     def getTubeOrientation(self, color_frame, tubeResults, centerx, centery):
         xdist = (tubeResults[0] - tubeResults[2])
         ydist = (tubeResults[1] - tubeResults[3])